@@ -0,0 +1,152 @@
+"""Segmented, append-only store of the event building output.
+
+Instead of merging every build part into an ever-growing `current_build.root`,
+the parts stay immutable segments. A small manifest in the run output dir lists
+them. Consumers read the segments as one logical chain (a `TChain`, or a list of
+files for uproot). Optionally, a background thread compacts runs of small
+segments into larger ones, without blocking the appending of new segments. The
+compacted parts are kept on disk: Other consumers still read the single parts.
+
+Each manifest line holds the segment path, followed by the build parts that it
+contains if it is a compacted segment. All paths are relative to the output dir.
+"""
+import os
+import threading
+
+manifest_name = "build_manifest.txt"
+
+
+class BuildStore:
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.manifest_path = os.path.join(output_dir, manifest_name)
+        self._lock = threading.Lock()
+        self._segments = []  # (segment, parts) with parts == (segment,) if single.
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                for line in filter(None, map(str.split, f)):
+                    self._segments.append((line[0], tuple(line[1:]) or (line[0],)))
+
+    def _relative(self, path):
+        return os.path.relpath(os.path.abspath(path), self.output_dir)
+
+    def _absolute(self, path):
+        return os.path.join(self.output_dir, path)
+
+    def _write_manifest(self):
+        lines = []
+        for segment, parts in self._segments:
+            if parts == (segment,):
+                lines.append(segment)
+            else:
+                lines.append(" ".join((segment,) + parts))
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("".join(line + "\n" for line in lines))
+        os.replace(tmp_path, self.manifest_path)
+
+    def append(self, part_path):
+        part = self._relative(part_path)
+        with self._lock:
+            self._segments.append((part, (part,)))
+            self._write_manifest()
+
+    def reconcile(self, part_paths):
+        """Add parts that were written, but not recorded (e.g. after a crash)."""
+        with self._lock:
+            known = {p for _, parts in self._segments for p in parts}
+            missing = [p for p in map(self._relative, part_paths) if p not in known]
+            self._segments.extend((p, (p,)) for p in sorted(missing))
+            if missing:
+                self._write_manifest()
+        return len(missing)
+
+    def segment_paths(self):
+        with self._lock:
+            return [self._absolute(segment) for segment, _ in self._segments]
+
+    def n_parts(self):
+        with self._lock:
+            return sum(len(parts) for _, parts in self._segments)
+
+    def uncompacted(self):
+        """The single-part segments, in manifest order."""
+        with self._lock:
+            return [self._absolute(s) for s, parts in self._segments if parts == (s,)]
+
+    def replace(self, part_paths, compacted_path):
+        """Swap the single-part segments for the segment that contains them all."""
+        replaced = set(map(self._relative, part_paths))
+        compacted = self._relative(compacted_path)
+        with self._lock:
+            position = min(
+                i for i, (s, _) in enumerate(self._segments) if s in replaced
+            )
+            self._segments = [s for s in self._segments if s[0] not in replaced]
+            parts = tuple(self._relative(p) for p in part_paths)
+            self._segments.insert(position, (compacted, parts))
+            self._write_manifest()
+
+
+class SegmentCompactor:
+    """Background thread that merges `parts_per_segment` single-part segments.
+
+    `merge_function(out_path, in_paths)` must create `out_path` from `in_paths`.
+    """
+
+    def __init__(
+        self, store, merge_function, compacted_dir, tmp_dir, parts_per_segment
+    ):
+        assert parts_per_segment >= 2, parts_per_segment
+        self.store = store
+        self.merge_function = merge_function
+        self.compacted_dir = compacted_dir
+        self.tmp_dir = tmp_dir
+        self.parts_per_segment = parts_per_segment
+        self.exception = None
+        self._wake_up = threading.Event()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="📚  ", daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        self._wake_up.set()
+
+    def _next_name(self):
+        ids = [
+            int(f[len("compacted_") : -len(".root")])
+            for f in os.listdir(self.compacted_dir)
+            if f.startswith("compacted_")
+        ]
+        next_id = max(ids) + 1 if ids else 0
+        return os.path.join(self.compacted_dir, f"compacted_{next_id:04}.root")
+
+    def _run(self):
+        try:
+            while not self._stop:
+                self._wake_up.wait()
+                self._wake_up.clear()
+                while not self._stop and self._compact_next():
+                    pass
+        except BaseException as e:
+            self.exception = e
+
+    def _compact_next(self):
+        uncompacted = self.store.uncompacted()
+        if len(uncompacted) < self.parts_per_segment:
+            return False
+        batch = uncompacted[: self.parts_per_segment]
+        out_path = self._next_name()
+        tmp_path = os.path.join(self.tmp_dir, os.path.basename(out_path))
+        self.merge_function(tmp_path, batch)
+        os.rename(tmp_path, out_path)
+        self.store.replace(batch, out_path)
+        return True
+
+    def close(self):
+        """Lets an ongoing compaction finish."""
+        self._stop = True
+        self._wake_up.set()
+        self._thread.join()
+        if self.exception is not None:
+            raise self.exception
@@ -0,0 +1,127 @@
+"""Build events in long-lived worker processes instead of one subprocess per part.
+
+Every worker imports pyROOT and the event building code once. A build request then
+executes `build_events.py` in that warm interpreter, with the same command line
+arguments as the subprocess path. The output files are thus produced by the very
+same code. As for a subprocess, stdout and stderr are captured on the file
+descriptor level (ROOT writes directly to them, bypassing `sys.stdout`).
+
+What is saved per part is the interpreter and pyROOT start-up. `build_events.py`
+still reads the calibration and masking files itself for every part.
+"""
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+import runpy
+import subprocess
+import sys
+import tempfile
+import traceback
+
+_builder_script = "build_events.py"
+
+
+def _flush_c_streams():
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is not None:
+        ctypes.CDLL(libc_name).fflush(None)
+
+
+@contextlib.contextmanager
+def _captured_output():
+    captured = {}
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved_fds = os.dup(1), os.dup(2)
+        os.dup2(out.fileno(), 1)
+        os.dup2(err.fileno(), 2)
+        try:
+            yield captured
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            _flush_c_streams()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            for fd in saved_fds:
+                os.close(fd)
+            for name, f in [("stdout", out), ("stderr", err)]:
+                f.seek(0)
+                captured[name] = f.read()
+
+
+_all_started = None
+
+
+def _init_worker(builder_dir, all_started):
+    global _all_started
+    _all_started = all_started
+    os.chdir(builder_dir)
+    sys.path.insert(0, builder_dir)
+    # Module-level code only: the imports (pyROOT, helpers) are cached from now on.
+    with _captured_output():
+        runpy.run_path(_builder_script, run_name="build_events_preload")
+
+
+def _warm_up():
+    # Blocks each worker on its first task. The executor has no idle worker then,
+    # and forks a new one for each further task (also where it forks on demand).
+    _all_started.wait()
+    return os.getpid()
+
+
+def _build(cli_args):
+    returncode = 0
+    sys.argv = ["./" + _builder_script] + list(cli_args)
+    with _captured_output() as captured:
+        try:
+            runpy.run_path(_builder_script, run_name="__main__")
+        except SystemExit as e:
+            if e.code not in [None, 0]:
+                returncode = e.code if isinstance(e.code, int) else 1
+                if not isinstance(e.code, int):
+                    print(e.code, file=sys.stderr)
+        except Exception:
+            returncode = 1
+            traceback.print_exc()
+    return subprocess.CompletedProcess(
+        args=sys.argv,
+        returncode=returncode,
+        stdout=captured["stdout"],
+        stderr=captured["stderr"],
+    )
+
+
+class EventBuildingPool:
+    """A `ProcessPoolExecutor` whose workers build events on request.
+
+    All workers are forked (and warmed up) in the constructor. As forking a
+    multi-threaded process is unsafe, create the pool before starting any threads.
+    """
+
+    def __init__(self, builder_dir, max_workers=1):
+        assert os.path.isfile(os.path.join(builder_dir, _builder_script)), builder_dir
+        context = multiprocessing.get_context("fork")
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(builder_dir, context.Barrier(max_workers)),
+        )
+        warm_ups = [self._executor.submit(_warm_up) for _ in range(max_workers)]
+        for warm_up in warm_ups:
+            warm_up.result()
+
+    def build(self, cli_args):
+        """Same arguments as for `./build_events.py`. Blocks until done.
+
+        Returns a `subprocess.CompletedProcess`.
+        """
+        return self._executor.submit(_build, cli_args).result()
+
+    def close(self):
+        self._executor.shutdown()
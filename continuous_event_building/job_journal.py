@@ -0,0 +1,176 @@
+"""Append-only journal of the stage transitions of each part, for resuming a run.
+
+The journal is a small SQLite file in the run output dir. Every time a part
+reaches a new stage (e.g. `converted`, `merged`), a row with the part name, its
+job id and the output path is appended. On a restart, the rows are replayed
+into memory: The latest stage of each part tells which jobs are still missing,
+without listing the output folders or parsing ids from file names.
+
+Besides the stages, the journal keeps the first time that a part reached each
+milestone of its lifecycle (`discovered`, `built`, in a `snapshot`, in the
+`quality` info, ...). The lag between them tells how fresh the monitoring is.
+
+The part name is the file name without its stage prefix and `.root` suffix, so
+that the rows of the same part match across stages.
+"""
+import collections
+import math
+import os
+import sqlite3
+import threading
+import time
+
+journal_name = "job_journal.sqlite"
+stage_prefixes = ["converted_", "build_"]
+
+Entry = collections.namedtuple("Entry", ["id", "stage", "path"])
+
+
+def part_name(path):
+    name = os.path.basename(path)
+    for prefix in stage_prefixes:
+        if name.startswith(prefix):
+            name = name[len(prefix) :]
+            break
+    if name.endswith(".root"):
+        name = name[: -len(".root")]
+    if name.endswith(".dat") or name.endswith("raw.bin"):
+        name += "_0000"  # As the converter names the first part.
+    return name
+
+
+def lag_summary(lags):
+    """p50/p95/max of a list of lags in seconds, as a string for the log."""
+    lags = sorted(lags)
+
+    def percentile(q):
+        return lags[max(0, math.ceil(q / 100 * len(lags)) - 1)]  # Nearest rank.
+
+    return (
+        f"p50 {percentile(50):.0f}s, p95 {percentile(95):.0f}s, max {lags[-1]:.0f}s "
+        f"over {len(lags)} parts"
+    )
+
+
+class JobJournal:
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, journal_name)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS transitions ("
+            "part TEXT NOT NULL, id INTEGER, stage TEXT NOT NULL, "
+            "path TEXT NOT NULL, time REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS milestones ("
+            "part TEXT NOT NULL, milestone TEXT NOT NULL, time REAL NOT NULL, "
+            "PRIMARY KEY (part, milestone))"
+        )
+        self._db.commit()
+        self._parts = {}
+        self._counts = collections.Counter()
+        self._first_times = collections.defaultdict(dict)
+        rows = self._db.execute(
+            "SELECT part, id, stage, path, time FROM transitions ORDER BY rowid"
+        )
+        for part, id_part, stage, path, timestamp in rows:
+            self._replay(part, id_part, stage, path, timestamp)
+        for part, milestone, timestamp in self._db.execute(
+            "SELECT part, milestone, time FROM milestones"
+        ):
+            self._first_times[part].setdefault(milestone, timestamp)
+
+    def _replay(self, part, id_part, stage, path, timestamp):
+        previous = self._parts.get(part)
+        if previous is not None:
+            self._counts[previous.stage] -= 1
+            if id_part is None:
+                id_part = previous.id
+        self._parts[part] = Entry(id_part, stage, path)
+        self._counts[stage] += 1
+        self._first_times[part].setdefault(stage, timestamp)
+
+    def record(self, stage, path, id_part=None):
+        """The part of `path` reached `stage`. The id is kept from earlier stages."""
+        part = part_name(path)
+        timestamp = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO transitions VALUES (?, ?, ?, ?, ?)",
+                (part, id_part, stage, os.path.abspath(path), timestamp),
+            )
+            self._db.commit()
+            self._replay(part, id_part, stage, os.path.abspath(path), timestamp)
+
+    def mark(self, milestone, paths, timestamp=None, since="discovered"):
+        """Note the parts that reach `milestone` for the first time.
+
+        Returns the lags (in seconds) of these parts since their `since` milestone.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        lags = []
+        with self._lock:
+            new_parts = []
+            for part in map(part_name, paths):
+                first_times = self._first_times[part]
+                if milestone in first_times:
+                    continue
+                first_times[milestone] = timestamp
+                new_parts.append(part)
+                if since in first_times:
+                    lags.append(timestamp - first_times[since])
+            if new_parts:
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO milestones VALUES (?, ?, ?)",
+                    [(part, milestone, timestamp) for part in new_parts],
+                )
+                self._db.commit()
+        return lags
+
+    def first_time(self, path, milestone):
+        with self._lock:
+            return self._first_times.get(part_name(path), {}).get(milestone)
+
+    def lags(self, milestone, since="discovered"):
+        """The lags of all parts that reached `milestone` after `since`."""
+        with self._lock:
+            return [
+                times[milestone] - times[since]
+                for times in self._first_times.values()
+                if milestone in times and since in times
+            ]
+
+    def is_empty(self):
+        with self._lock:
+            return len(self._parts) == 0
+
+    def stage(self, path):
+        """The latest stage of the part of `path`, None if it was never recorded."""
+        with self._lock:
+            entry = self._parts.get(part_name(path))
+        return None if entry is None else entry.stage
+
+    def n_parts(self, stage):
+        """How many parts are (at latest) in this stage."""
+        with self._lock:
+            return self._counts[stage]
+
+    def entries(self, stage=None):
+        """{part: Entry}, optionally only of the parts whose latest stage is this."""
+        with self._lock:
+            return {
+                part: entry
+                for part, entry in self._parts.items()
+                if stage is None or entry.stage == stage
+            }
+
+    def paths(self, stage):
+        return sorted(entry.path for entry in self.entries(stage).values())
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,184 @@
+"""Live view of the monitoring loop, in the Prometheus text format.
+
+The `Timer` rows in `.times/` are only written when the loop has finished. The
+metrics here are updated while the run is monitored: Per-stage job counts,
+job duration histograms, processed bytes, queue depths and busy/idle workers.
+
+They are either served on a localhost HTTP endpoint (`/metrics`), or a textfile
+is rewritten every few seconds (e.g. for the textfile collector of the
+Prometheus node exporter, or simply for `cat`).
+"""
+import collections
+import http.server
+import logging
+import os
+import threading
+import time
+
+duration_buckets = [0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600]
+textfile_name = "monitoring_metrics.prom"
+
+
+class LiveMetrics:
+    """Collect the job metrics. `sample()` returns the current gauges.
+
+    `sample` is called whenever the metrics are exported, and should return
+    {"queue_depth": {stage: n}, "workers": {state: n}}.
+    """
+
+    def __init__(
+        self,
+        sample,
+        mode="textfile",
+        output_dir=".",
+        port=9108,
+        interval=5,
+        logger=None,
+    ):
+        assert mode in ["textfile", "http"], mode
+        self._sample = sample
+        self._logger = logger if logger is not None else logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._jobs = collections.Counter()
+        self._bytes = collections.Counter()
+        self._duration_sum = collections.Counter()
+        self._duration_buckets = collections.defaultdict(
+            lambda: [0] * len(duration_buckets)
+        )
+        self._last_bytes = (self._start_time, collections.Counter())
+        self._bytes_per_second = collections.Counter()
+        self._stop = threading.Event()
+        self.textfile_path = None
+        self._server = None
+        if mode == "textfile":
+            self.textfile_path = os.path.join(output_dir, textfile_name)
+            target = self._rewrite_textfile
+            self._interval = interval
+        else:
+            self._server = http.server.ThreadingHTTPServer(
+                ("127.0.0.1", port), _handler_for(self)
+            )
+            target = self._server.serve_forever
+        self._thread = threading.Thread(target=target, name="📊  ", daemon=True)
+        self._thread.start()
+
+    def job_done(self, stage, duration, n_bytes=0):
+        with self._lock:
+            self._jobs[stage] += 1
+            self._bytes[stage] += n_bytes
+            self._duration_sum[stage] += duration
+            buckets = self._duration_buckets[stage]
+            for i, upper_edge in enumerate(duration_buckets):
+                if duration <= upper_edge:
+                    buckets[i] += 1
+
+    def _update_rates(self):
+        now = time.time()
+        last_time, last_bytes = self._last_bytes
+        if now - last_time <= 0:
+            return
+        for stage, n_bytes in self._bytes.items():
+            rate = (n_bytes - last_bytes[stage]) / (now - last_time)
+            self._bytes_per_second[stage] = rate
+        self._last_bytes = (now, collections.Counter(self._bytes))
+
+    def render(self):
+        sample = self._sample()
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP monitoring_{name} {help_text}")
+            lines.append(f"# TYPE monitoring_{name} {kind}")
+
+        with self._lock:
+            self._update_rates()
+            metric("jobs_total", "counter", "Finished jobs per stage.")
+            for stage, n in sorted(self._jobs.items()):
+                lines.append(f'monitoring_jobs_total{{stage="{stage}"}} {n}')
+            metric("job_duration_seconds", "histogram", "Job duration per stage.")
+            for stage, buckets in sorted(self._duration_buckets.items()):
+                for upper_edge, n in zip(duration_buckets, buckets):
+                    lines.append(
+                        "monitoring_job_duration_seconds_bucket"
+                        f'{{stage="{stage}",le="{upper_edge}"}} {n}'
+                    )
+                lines.append(
+                    "monitoring_job_duration_seconds_bucket"
+                    f'{{stage="{stage}",le="+Inf"}} {self._jobs[stage]}'
+                )
+                lines.append(
+                    "monitoring_job_duration_seconds_sum"
+                    f'{{stage="{stage}"}} {self._duration_sum[stage]:.3f}'
+                )
+                lines.append(
+                    "monitoring_job_duration_seconds_count"
+                    f'{{stage="{stage}"}} {self._jobs[stage]}'
+                )
+            metric("processed_bytes_total", "counter", "Input bytes per stage.")
+            for stage, n_bytes in sorted(self._bytes.items()):
+                lines.append(
+                    f'monitoring_processed_bytes_total{{stage="{stage}"}} {n_bytes}'
+                )
+            metric(
+                "processed_bytes_per_second",
+                "gauge",
+                "Input bytes per second since the previous export.",
+            )
+            for stage, rate in sorted(self._bytes_per_second.items()):
+                lines.append(
+                    "monitoring_processed_bytes_per_second"
+                    f'{{stage="{stage}"}} {rate:.1f}'
+                )
+        metric("queue_depth", "gauge", "Queued jobs per stage.")
+        for stage, n in sorted(sample["queue_depth"].items()):
+            lines.append(f'monitoring_queue_depth{{stage="{stage}"}} {n}')
+        metric("workers", "gauge", "Workers per state.")
+        for state, n in sorted(sample["workers"].items()):
+            lines.append(f'monitoring_workers{{state="{state}"}} {n}')
+        metric("uptime_seconds", "gauge", "Time since the monitoring loop started.")
+        lines.append(f"monitoring_uptime_seconds {time.time() - self._start_time:.0f}")
+        return "\n".join(lines) + "\n"
+
+    def _write_textfile(self):
+        tmp_path = self.textfile_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, self.textfile_path)
+
+    def _rewrite_textfile(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self._write_textfile()
+            except Exception as e:
+                # E.g. a full disk or a failing `sample`: Try again next time.
+                self._logger.warning(f"📊Could not update the live metrics ({e!r}).")
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        else:
+            self._stop.set()
+        self._thread.join()
+        if self.textfile_path is not None:
+            self._write_textfile()
+
+
+def _handler_for(live_metrics):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ["/", "/metrics"]:
+                self.send_error(404)
+                return
+            body = live_metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # No access log in the monitoring output.
+
+    return MetricsHandler
@@ -1,6 +1,80 @@
+"""Data quality plots from per-build-part aggregates.
+
+Each build part is read only once. Its partial aggregates (coincidence counts,
+per-slab hit counts, per-slab energy sums and sums of squares, an event-energy
+histogram and the cycle range per id_dat) are stored as `.npz` files in the
+`aggregates_dir`, next to `build/`. Redrawing the plots only combines these small
+aggregates, with O(parts) work.
+
+With `chunk_mb`, a build part is read in chunks of about that many MB
+(`uproot.iterate`), so that the peak memory does not depend on the part size.
+"""
+import concurrent.futures
 import logging
+import multiprocessing
 import os
-import queue
+import shutil
+import threading
+import time
+
+
+class QualityRenderer:
+    """Draws the quality plots in a background process.
+
+    Requests that arrive while a render is in progress are coalesced: Only the
+    latest one is drawn next. `on_rendered(img_path, duration, build_parts)` is
+    called after each render, with the build parts of the drawn request. Create
+    the renderer before starting any threads (fork).
+    """
+
+    def __init__(self, logger, on_rendered=None):
+        self.logger = logger
+        self.on_rendered = on_rendered
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("fork")
+        )
+        self._executor.submit(os.getpid).result()
+        self._pending = None
+        self._closing = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="🥨  ", daemon=True)
+        self._thread.start()
+
+    def request(self, render_args, log_text, build_parts=()):
+        """`render_args` as for `render_quality`. Does not block."""
+        with self._condition:
+            if self._pending is not None:
+                self.logger.debug("🥨Coalesced with a newer quality info request.")
+            self._pending = render_args, log_text, build_parts
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closing:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                render_args, log_text, build_parts = self._pending
+                self._pending = None
+            try:
+                future = self._executor.submit(render_quality, *render_args)
+                duration = future.result()
+            except Exception as e:
+                self.logger.error(f"🥨The quality plots could not be drawn: {e}")
+                continue
+            self.logger.info(log_text)
+            if self.on_rendered is not None:
+                self.on_rendered(render_args[3], duration, build_parts)
+
+    def close(self):
+        """Draws the last pending request before returning."""
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join()
+        self._executor.shutdown()
+
 
 try:
     import awkward as ak
@@ -16,49 +90,197 @@ try:
     logging.getLogger("matplotlib").setLevel(level=logging.ERROR)
     matplotlib.use("agg")
 
-    def get_quality_info(current_build_queue, monitoring, finished=False):
-        try:
-            current_build = current_build_queue.get(timeout=2)
-        except queue.Empty:
-            return False
-        id_dat = uproot.open(current_build)["ecal/id_dat"].array()
-        cycles = uproot.open(current_build)["ecal/cycle"].array()
-        nhit_slab = uproot.open(current_build)["ecal/nhit_slab"].array()
-        hit_slab = uproot.open(current_build)["ecal/hit_slab"].array()
-        energy = uproot.open(current_build)["ecal/hit_energy"].array()
-        is_hit = uproot.open(current_build)["ecal/hit_isHit"].array()
-        current_build_queue.put(current_build)
-        current_build_queue.task_done()
-
-        slabs = np.arange(ak.min(hit_slab), ak.max(hit_slab) + 1)
+    event_energy_bin_width = 0.05
+    _branches = ["id_dat", "cycle", "nhit_slab", "hit_slab", "hit_energy", "hit_isHit"]
+    _aggregates = {}  # In-memory cache of the aggregate files.
+
+    def _layer_factors(w_config, n_slabs):
         dEdx_w = 2 * 19.25 / 1000
-        if "," in monitoring._w_config:
-            w_conf = np.array(list(map(float, monitoring._w_config.split(","))))
+        if "," in w_config:
+            w_conf = np.array(list(map(float, w_config.split(","))))
+            assert len(w_conf) >= n_slabs, f"w_config for only {len(w_conf)} slabs."
+            w_conf = w_conf[:n_slabs]
         else:
-            w_conf = np.full_like(slabs, float(monitoring._w_config))
+            w_conf = np.full(n_slabs, float(w_config))
         f_layer = w_conf * dEdx_w
         f_layer[f_layer == 0] = 1
+        return f_layer
+
+    def _aggregate(ecal, w_config):
+        id_dat = ak.to_numpy(ecal["id_dat"])
+        cycles = ak.to_numpy(ecal["cycle"])
+        n_events = len(id_dat)
+        hit_slab = ak.to_numpy(ak.flatten(ecal["hit_slab"])).astype(np.int64)
+        energy = ak.to_numpy(ak.flatten(ecal["hit_energy"]))
+        is_hit = ak.to_numpy(ak.flatten(ecal["hit_isHit"]))
+        n_slabs = int(hit_slab.max()) + 1 if len(hit_slab) else 0
+
+        # Per event and slab: the energy sum of the hits with energy.
+        i_event = np.repeat(np.arange(n_events), ak.to_numpy(ak.num(ecal["hit_slab"])))
+        with_energy = (is_hit > 0) & (energy > 0)
+        slab_energy = np.bincount(
+            i_event[with_energy] * n_slabs + hit_slab[with_energy],
+            weights=energy[with_energy],
+            minlength=n_events * n_slabs,
+        ).reshape(n_events, n_slabs)
+        event_energy = slab_energy @ _layer_factors(w_config, n_slabs)
+        energy_bins, energy_counts = np.unique(
+            np.floor(event_energy / event_energy_bin_width).astype(np.int64),
+            return_counts=True,
+        )
+
+        dat_ids = np.unique(id_dat)
+        return dict(
+            w_config=np.array(w_config),
+            n_events=np.array(n_events),
+            coincidences=np.bincount(ak.to_numpy(ecal["nhit_slab"]).astype(np.int64)),
+            slab_hits=np.bincount(hit_slab, minlength=n_slabs),
+            slab_energy_sum=slab_energy.sum(axis=0),
+            slab_energy_sumsq=(slab_energy**2).sum(axis=0),
+            event_energy_bins=energy_bins,
+            event_energy_counts=energy_counts,
+            dat_ids=dat_ids,
+            cycle_min=np.array([cycles[id_dat == i].min() for i in dat_ids]),
+            cycle_max=np.array([cycles[id_dat == i].max() for i in dat_ids]),
+        )
+
+    def part_aggregates(build_part, w_config, chunk_mb=0):
+        """The partial aggregates of a single build part, as a dict of arrays."""
+        if chunk_mb <= 0:
+            with uproot.open(build_part) as f:
+                return _aggregate(f["ecal"].arrays(_branches), w_config)
+        total = combine_aggregates(
+            _aggregate(ecal, w_config)
+            for ecal in uproot.iterate(
+                build_part + ":ecal", _branches, step_size=f"{chunk_mb} MB"
+            )
+        )
+        cycle_ranges = total.pop("cycle_ranges")
+        dat_ids = np.array(sorted(cycle_ranges))
+        total.update(
+            w_config=np.array(w_config),
+            n_events=np.array(total["n_events"]),
+            dat_ids=dat_ids,
+            cycle_min=np.array([cycle_ranges[i][0] for i in dat_ids]),
+            cycle_max=np.array([cycle_ranges[i][1] for i in dat_ids]),
+        )
+        return total
 
-        parts = np.unique(ak.to_numpy(id_dat))
+    def cached_part_aggregates(build_part, aggregates_dir, w_config, chunk_mb=0):
+        """Computed once per build part, then read from memory or disk."""
+        cache_path = os.path.join(aggregates_dir, os.path.basename(build_part))
+        cache_path = os.path.splitext(cache_path)[0] + ".npz"
+        aggregates = _aggregates.get(cache_path)
+        if aggregates is None and os.path.exists(cache_path):
+            with np.load(cache_path) as npz:
+                aggregates = dict(npz)
+        if aggregates is None or str(aggregates["w_config"]) != w_config:
+            aggregates = part_aggregates(build_part, w_config, chunk_mb)
+            tmp_path = cache_path + ".tmp.npz"
+            np.savez(tmp_path, **aggregates)
+            os.replace(tmp_path, cache_path)
+        _aggregates[cache_path] = aggregates
+        return aggregates
+
+    def _add_padded(a, b):
+        if len(a) < len(b):
+            a, b = b, a
+        a = a.copy()
+        a[: len(b)] += b
+        return a
+
+    def combine_aggregates(all_aggregates):
+        total = dict(
+            n_events=0,
+            coincidences=np.zeros(0, dtype=np.int64),
+            slab_hits=np.zeros(0, dtype=np.int64),
+            slab_energy_sum=np.zeros(0),
+            slab_energy_sumsq=np.zeros(0),
+        )
+        cycle_ranges = {}
+        energy_bins, energy_counts = [], []
+        for aggregates in all_aggregates:
+            total["n_events"] += int(aggregates["n_events"])
+            for key in list(total)[1:]:
+                total[key] = _add_padded(total[key], aggregates[key])
+            energy_bins.append(aggregates["event_energy_bins"])
+            energy_counts.append(aggregates["event_energy_counts"])
+            for i, c_min, c_max in zip(
+                aggregates["dat_ids"], aggregates["cycle_min"], aggregates["cycle_max"]
+            ):
+                c_range = cycle_ranges.get(i, (c_min, c_max))
+                cycle_ranges[i] = min(c_range[0], c_min), max(c_range[1], c_max)
+        total["event_energy_bins"], inverse = np.unique(
+            np.concatenate(energy_bins or [np.zeros(0, dtype=np.int64)]),
+            return_inverse=True,
+        )
+        total["event_energy_counts"] = np.bincount(
+            inverse, weights=np.concatenate(energy_counts or [np.zeros(0)])
+        )
+        total["cycle_ranges"] = cycle_ranges
+        return total
+
+    def get_quality_info(
+        monitoring, build_parts, aggregates_dir, finished=False, renderer=None
+    ):
+        """Without a `renderer`, the plots are drawn right away."""
+        total = combine_aggregates(
+            cached_part_aggregates(
+                p, aggregates_dir, monitoring._w_config, monitoring._quality_chunk_mb
+            )
+            for p in build_parts
+        )
+        if total["n_events"] == 0:
+            return True
+        cycle_ranges = np.array(list(total.pop("cycle_ranges").values()))
         if finished:
-            n_cycles = np.max(cycles) - np.min(cycles) + 1
+            n_cycles = cycle_ranges[:, 1].max() - cycle_ranges[:, 0].min() + 1
         else:
             # We cannot just take the unique values: There can be empty cycles.
-            n_cycles = 0
-            for part_id in parts:
-                cycles_in_part = cycles[id_dat == part_id]
-                n_cycles += np.max(cycles_in_part) - np.min(cycles_in_part) + 1
+            n_cycles = np.sum(cycle_ranges[:, 1] - cycle_ranges[:, 0] + 1)
         title_text = f"{n_cycles} cycles monitored"
         if not finished:
-            title_text += f" in {len(parts)} parts (ongoing)"
+            title_text += f" in {len(cycle_ranges)} parts (ongoing)"
         title_text += f"\n{os.path.basename(monitoring.output_dir)}"
 
+        img_name = "data_quality." + monitoring._quality_format
+        in_data_img_path = os.path.join(monitoring.output_dir, img_name)
+        monitoring_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        render_args = (
+            total,
+            title_text,
+            monitoring._w_config,
+            in_data_img_path,
+            [os.path.join(monitoring_root, img_name)],
+            monitoring._quality_dpi,
+        )
+        log_text = "🥨" + title_text.replace("\n", ". ") + ": " + in_data_img_path
+        if renderer is None:
+            render_quality(*render_args)
+            monitoring.logger.info(log_text)
+        else:
+            renderer.request(render_args, log_text, build_parts)
+        return True
+
+    def render_quality(quality, title_text, w_config, img_path, link_paths, dpi):
+        """Write the plots once to img_path, then link (or copy) them to link_paths.
+
+        Returns the time it took.
+        """
+        start_time = time.time()
+        has_hits = np.flatnonzero(quality["slab_hits"])
+        slabs = np.arange(has_hits.min(), has_hits.max() + 1)
+        f_layer = _layer_factors(w_config, len(quality["slab_hits"]))[slabs]
+
         fig, axs = plt.subplots(ncols=2, nrows=2, figsize=(12, 12))
         axs = axs.flatten()
         fig.suptitle(title_text)
+        coincidences = quality["coincidences"]
+        nhit_values = np.flatnonzero(coincidences)
         n, bins, _ = axs[0].hist(
-            nhit_slab,
-            bins=np.arange(ak.min(nhit_slab) - 0.5, ak.max(nhit_slab) + 1),
+            np.arange(len(coincidences)),
+            bins=np.arange(nhit_values.min() - 0.5, nhit_values.max() + 1),
+            weights=coincidences,
             cumulative=-1,
         )
         for i, counts in enumerate(n):
@@ -73,45 +295,56 @@ try:
         axs[0].set_xlabel("slab coincidence >=")
         axs[0].set_ylabel("# events")
 
-        axs[1].bar(slabs, [ak.sum(ak.sum(hit_slab == i, axis=1)) for i in slabs])
+        axs[1].bar(slabs, quality["slab_hits"][slabs])
         axs[1].set_xlabel("slab in coincidence")
         axs[1].set_ylabel("# events")
 
-        slab_energies = []
-        slab_energies_std = []
-        event_energy = np.zeros(len(energy))
-        for i, i_slab in enumerate(slabs):
-            e_in_slab = energy[(hit_slab == i_slab) & (is_hit > 0)]
-            e_in_slab = e_in_slab[e_in_slab > 0]
-            e_in_slab = e_in_slab * f_layer[i]
-            event_energy = event_energy + ak.sum(e_in_slab, axis=1)
-            e_flat = ak.flatten(ak.sum(e_in_slab, axis=1), axis=None)
-            slab_energies.append(np.mean(e_flat))
-            slab_energies_std.append(np.std(e_flat))
-
-        axs[2].bar(slabs, slab_energies, yerr=slab_energies_std)
+        # Mean and std of the per-event slab energy, over all events.
+        mean = quality["slab_energy_sum"][slabs] / quality["n_events"]
+        mean_sq = quality["slab_energy_sumsq"][slabs] / quality["n_events"]
+        std = np.sqrt(np.maximum(mean_sq - mean**2, 0))
+        axs[2].bar(slabs, mean * f_layer, yerr=std * f_layer)
         axs[2].set_xlabel("slab in coincidence")
         axs[2].set_ylabel("average energy")
 
-        axs[3].hist(event_energy, bins="auto")
+        # Fixed-width bins in the aggregates. For the plot, at most 100 bins.
+        energy_bins = quality["event_energy_bins"]
+        n_bins = energy_bins.max() - energy_bins.min() + 1
+        rebin = max(1, int(np.ceil(n_bins / 100)))
+        bin_edges = np.arange(energy_bins.min(), energy_bins.max() + rebin + 1, rebin)
+        axs[3].hist(
+            energy_bins * event_energy_bin_width,
+            bins=bin_edges * event_energy_bin_width,
+            weights=quality["event_energy_counts"],
+        )
         axs[3].set_xlabel("event energy")
         axs[3].set_ylabel("# events")
 
         fig.tight_layout()
-        in_data_img_path = os.path.join(monitoring.output_dir, "data_quality.png")
-        fig.savefig(in_data_img_path, dpi=300)
-        monitoring_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        fig.savefig(os.path.join(monitoring_root, "data_quality.png"), dpi=300)
-        monitoring.logger.info(
-            "🥨" + title_text.replace("\n", ". ") + ": " + in_data_img_path
-        )
+        # Replace atomically: The old image might be linked from elsewhere.
+        img_root, img_ext = os.path.splitext(img_path)
+        tmp_path = img_root + ".tmp" + img_ext
+        fig.savefig(tmp_path, dpi=dpi)
         plt.close(fig)
-        return True
+        os.replace(tmp_path, img_path)
+        for link_path in link_paths:
+            tmp_link = link_path + ".tmp"
+            try:
+                os.link(img_path, tmp_link)
+            except OSError:  # E.g. across file systems.
+                shutil.copy(img_path, tmp_link)
+            os.replace(tmp_link, link_path)
+        return time.time() - start_time
 
 except (ImportError, AssertionError) as e:
     no_quality_txt = "🥨No data quality info and plots will be provided. "
     no_quality_txt += str(e)
     print(no_quality_txt)
 
-    def get_quality_info(current_build_queue, monitoring, finished=False):
+    def get_quality_info(
+        monitoring, build_parts, aggregates_dir, finished=False, renderer=None
+    ):
         return True
+
+    def render_quality(quality, title_text, w_config, img_path, link_paths, dpi):
+        return 0
@@ -0,0 +1,146 @@
+"""Event-driven discovery of new files in the raw run folder.
+
+Uses the Linux inotify interface through ctypes, so no extra package is needed.
+On systems (or file systems) without inotify support, `RawFileWatcher` raises an
+`OSError` and the caller is expected to fall back to globbing the run folder.
+Note that inotify does not see files written by other hosts on network file
+systems. The glob scan should therefore be kept as a (slower) safety net.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import queue
+import select
+import struct
+import threading
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_event_header = struct.Struct("iIII")
+
+
+def _load_libc():
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is None:
+        raise OSError(errno.ENOSYS, "No libc found for inotify.")
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    for function_name in ["inotify_init1", "inotify_add_watch"]:
+        if not hasattr(libc, function_name):
+            raise OSError(errno.ENOSYS, f"libc does not provide {function_name}.")
+    return libc
+
+
+class RawFileWatcher:
+    """Collect the paths of files that were closed (or moved) in `folder`.
+
+    The watching happens in a daemon thread. Consumers call `pop_new_files`,
+    and can block on `wait` until something new arrived. Alternatively,
+    `on_new_file(path)` is called from the watching thread for each new file.
+    With `names`, only files with these names are reported. If the watching fails,
+    the error is logged and `is_alive()` turns False.
+    """
+
+    def __init__(
+        self, folder, poll_interval=1.0, on_new_file=None, names=None, logger=None
+    ):
+        self.folder = folder
+        self._logger = logger if logger is not None else logging.getLogger(__name__)
+        self._poll_interval = poll_interval
+        self._on_new_file = on_new_file
+        self._names = None if names is None else set(names)
+        self._new_files = queue.Queue()
+        self._has_news = threading.Event()
+        self._stop = threading.Event()
+        self._fd = self._add_inotify_watch(folder)
+        # Written to on `close`, so that `select` returns without a poll timeout.
+        self._wake_read, self._wake_write = os.pipe()
+        self._thread = threading.Thread(target=self._watch, name="👀  ", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _add_inotify_watch(folder):
+        libc = _load_libc()
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO
+        if libc.inotify_add_watch(fd, os.fsencode(folder), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, os.strerror(err), folder)
+        return fd
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def _watch(self):
+        try:
+            self._watch_events()
+        except Exception as e:
+            self._logger.error(
+                f"👀Stopped watching {self.folder} ({e!r}). "
+                "Falling back to scanning the folder."
+            )
+
+    def _watch_events(self):
+        while not self._stop.is_set():
+            readable, _, _ = select.select(
+                [self._fd, self._wake_read], [], [], self._poll_interval
+            )
+            if self._fd not in readable:
+                continue
+            try:
+                buffer = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            except OSError:
+                if self._stop.is_set():
+                    return
+                raise
+            for name in self._parse_events(buffer):
+                if self._names is not None and name not in self._names:
+                    continue
+                path = os.path.join(self.folder, name)
+                self._new_files.put(path)
+                self._has_news.set()
+                if self._on_new_file is not None:
+                    self._on_new_file(path)
+
+    @staticmethod
+    def _parse_events(buffer):
+        names = []
+        offset = 0
+        while offset + _event_header.size <= len(buffer):
+            _, _, _, name_length = _event_header.unpack_from(buffer, offset)
+            offset += _event_header.size
+            name = buffer[offset : offset + name_length].rstrip(b"\0")
+            offset += name_length
+            if name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def pop_new_files(self):
+        self._has_news.clear()
+        new_files = []
+        while True:
+            try:
+                new_files.append(self._new_files.get_nowait())
+            except queue.Empty:
+                return new_files
+
+    def wait(self, timeout=None):
+        """Block until a new file was seen or the timeout passed."""
+        return self._has_news.wait(timeout)
+
+    def close(self):
+        self._stop.set()
+        os.write(self._wake_write, b"\0")
+        self._thread.join()
+        os.close(self._fd)
+        os.close(self._wake_read)
+        os.close(self._wake_write)
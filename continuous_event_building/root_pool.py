@@ -0,0 +1,210 @@
+"""Long-lived ROOT interpreters that execute macros on request.
+
+Each call of `root -b -l -q macro.C(...)` pays the interpreter startup and the
+JIT compilation of the macro. For small parts this can take longer than the
+actual work. Here every interpreter loads its macro once and then receives the
+macro calls over its stdin pipe. The end of a call is recognized by a marker line
+that is written to both stdout and stderr.
+"""
+import collections
+import datetime
+import os
+import queue
+import subprocess
+import threading
+import time
+
+Timer = collections.namedtuple(
+    "Timer", ["job_type", "time", "timestamp", "id", "worker", "data_path"]
+)
+
+_done_marker = "@@root_pool_job_done@@"
+
+
+def as_cpp_literal(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+class RootInterpreter:
+    """A `root -b -l` process that has loaded a single macro."""
+
+    def __init__(self, macro_path, i_worker=0):
+        self.macro_path = os.path.abspath(macro_path)
+        self.macro_name = os.path.splitext(os.path.basename(self.macro_path))[0]
+        self.i_worker = i_worker
+        self._process = subprocess.Popen(
+            ["root", "-b", "-l"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=os.path.dirname(self.macro_path),
+        )
+        self._lines = {}
+        for stream_name in ["stdout", "stderr"]:
+            self._lines[stream_name] = queue.Queue()
+            stream = getattr(self._process, stream_name)
+            threading.Thread(
+                target=self._read_lines,
+                args=(stream, self._lines[stream_name]),
+                daemon=True,
+            ).start()
+        ret = self._execute(f".L {self.macro_path}")
+        if ret.returncode != 0 or ret.stderr != b"":
+            self.close()
+            raise RootPoolError(ret)
+
+    @staticmethod
+    def _read_lines(stream, line_queue):
+        for line in iter(stream.readline, b""):
+            line_queue.put(line)
+        line_queue.put(None)  # The interpreter is gone.
+
+    def is_alive(self):
+        return self._process.poll() is None
+
+    def _collect(self, stream_name):
+        lines = []
+        while True:
+            line = self._lines[stream_name].get()
+            if line is None:
+                return b"".join(lines), False
+            if line.rstrip(b"\n") == _done_marker.encode():
+                return b"".join(lines), True
+            lines.append(line)
+
+    def _execute(self, command):
+        marker_cmd = (
+            f'std::cout << "\\n{_done_marker}" << std::endl; '
+            f'std::cerr << "\\n{_done_marker}" << std::endl;'
+        )
+        try:
+            self._process.stdin.write(f"{command}\n{marker_cmd}\n".encode())
+            self._process.stdin.flush()
+        except BrokenPipeError:
+            pass
+        stdout, stdout_done = self._collect("stdout")
+        stderr, stderr_done = self._collect("stderr")
+        if stdout_done and stderr_done:
+            returncode = 0
+        else:
+            # The interpreter died (e.g. segfault in the macro).
+            returncode = self._process.wait() or 1
+        return subprocess.CompletedProcess(
+            args=command,
+            returncode=returncode,
+            stdout=self._strip_marker_newline(stdout, stdout_done),
+            stderr=self._strip_marker_newline(stderr, stderr_done),
+        )
+
+    @staticmethod
+    def _strip_marker_newline(output, marker_found):
+        """The marker is preceded by a newline that is not part of the output."""
+        if marker_found and output.endswith(b"\n"):
+            return output[:-1]
+        return output
+
+    def call(self, *args):
+        call = f"{self.macro_name}({', '.join(map(as_cpp_literal, args))});"
+        # Macros do not necessarily close their input files.
+        return self._execute(call + " gROOT->CloseFiles();")
+
+    def close(self):
+        if self.is_alive():
+            try:
+                self._process.stdin.write(b".q\n")
+                self._process.stdin.close()
+                self._process.wait(timeout=10)
+            except (BrokenPipeError, subprocess.TimeoutExpired):
+                self._process.kill()
+                self._process.wait()
+
+
+class RootPoolError(Exception):
+    pass
+
+
+class RootInterpreterPool:
+    """Hand out (and start on demand) interpreters per macro.
+
+    At most `max_per_macro` interpreters are kept for each macro. Different
+    macros are never loaded into the same interpreter: they might define the
+    same symbols.
+    """
+
+    def __init__(self, max_per_macro=1, logger=None):
+        assert max_per_macro >= 1, max_per_macro
+        self.max_per_macro = max_per_macro
+        self.logger = logger
+        self.times = []
+        self._idle = collections.defaultdict(list)
+        self._n_started = collections.defaultdict(int)
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def _acquire(self, macro_path):
+        with self._condition:
+            while True:
+                assert not self._closed, "The ROOT interpreter pool was closed."
+                if self._idle[macro_path]:
+                    return self._idle[macro_path].pop()
+                if self._n_started[macro_path] < self.max_per_macro:
+                    i_worker = self._n_started[macro_path]
+                    self._n_started[macro_path] += 1
+                    break
+                self._condition.wait()
+        try:
+            interpreter = RootInterpreter(macro_path, i_worker)
+        except Exception:
+            with self._condition:
+                self._n_started[macro_path] -= 1
+                self._condition.notify()
+            raise
+        if self.logger is not None:
+            self.logger.debug(
+                f"🌳Started ROOT interpreter #{i_worker} for {macro_path}."
+            )
+        return interpreter
+
+    def _release(self, interpreter):
+        with self._condition:
+            if interpreter.is_alive() and not self._closed:
+                self._idle[interpreter.macro_path].append(interpreter)
+            else:
+                interpreter.close()
+                self._n_started[interpreter.macro_path] -= 1
+            self._condition.notify()
+
+    def run(self, macro_path, *args, timer_id=-1, data_path=""):
+        """Execute `macro(*args)`. Returns a `subprocess.CompletedProcess`."""
+        macro_path = os.path.abspath(macro_path)
+        start_time = time.time()
+        interpreter = self._acquire(macro_path)
+        try:
+            ret = interpreter.call(*args)
+        finally:
+            self._release(interpreter)
+        self.times.append(
+            Timer(
+                job_type="ROOT_" + interpreter.macro_name,
+                time=time.time() - start_time,
+                timestamp=datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S"),
+                id=timer_id,
+                worker=interpreter.i_worker,
+                data_path=data_path,
+            )
+        )
+        return ret
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            interpreters = [i for idle in self._idle.values() for i in idle]
+            self._idle.clear()
+            self._condition.notify_all()
+        for interpreter in interpreters:
+            interpreter.close()
@@ -0,0 +1,89 @@
+"""Read single files from .tar.gz archives without extracting the whole archive.
+
+`TarMemberFifo` decompresses a member through a named pipe. The consumer (e.g. the
+ROOT converter) opens the pipe like a normal file and reads it sequentially, while
+no uncompressed copy is written to disk.
+"""
+import os
+import shutil
+import tarfile
+import threading
+import time
+
+_chunk_size = 1024**2
+
+
+def _find_member(tar, member_name):
+    for member in tar:
+        if os.path.basename(member.name) == member_name and member.isfile():
+            return member
+    raise FileNotFoundError(f"{member_name} not found in {tar.name}")
+
+
+def member_size(tar_path, member_name):
+    """Uncompressed size, from the tar headers."""
+    with tarfile.open(tar_path, "r|gz") as tar:
+        return _find_member(tar, member_name).size
+
+
+def extract_member(tar_path, member_name, out_path):
+    """Stream a single member to out_path (instead of `extractall`)."""
+    with tarfile.open(tar_path, "r|gz") as tar:
+        member = _find_member(tar, member_name)
+        with tar.extractfile(member) as src, open(out_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, _chunk_size)
+        return member.size
+
+
+class TarMemberFifo:
+    """Context manager: While active, `fifo_path` delivers the member's content.
+
+    Throughput information is available after exiting the context.
+    """
+
+    def __init__(self, tar_path, member_name, fifo_path):
+        self.tar_path = tar_path
+        self.member_name = member_name
+        self.fifo_path = fifo_path
+        self.n_bytes = 0
+        self.time = 0
+        self._exception = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+
+    def __enter__(self):
+        os.mkfifo(self.fifo_path)
+        self._thread.start()
+        return self
+
+    def _write(self):
+        start_time = time.time()
+        try:
+            # Opened first: Even with a missing member or a corrupt archive, the
+            # reader gets an EOF instead of waiting for a writer forever.
+            with open(self.fifo_path, "wb") as dst:
+                with tarfile.open(self.tar_path, "r|gz") as tar:
+                    member = _find_member(tar, self.member_name)
+                    with tar.extractfile(member) as src:
+                        for chunk in iter(lambda: src.read(_chunk_size), b""):
+                            dst.write(chunk)
+                            self.n_bytes += len(chunk)
+        except BrokenPipeError:
+            pass  # The reader stopped early. Its return code tells if it is an issue.
+        except Exception as e:
+            self._exception = e
+        self.time = time.time() - start_time
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # If the reader never opened the pipe, the writer is still waiting for one.
+        while self._thread.is_alive():
+            fd = os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+            self._thread.join(timeout=0.1)
+            os.close(fd)
+        os.remove(self.fifo_path)
+        if self._exception is not None and exc_type is None:
+            raise self._exception
+
+    @property
+    def throughput(self):
+        """Decompressed bytes per second."""
+        return self.n_bytes / self.time if self.time > 0 else 0
@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 import argparse
 import collections
+import concurrent.futures
 import datetime
+import functools
+import importlib.util
 import logging
 import os
+import shutil
 import subprocess
+import sys
+import threading
 import time
 
+try:
+    import uproot
+except ImportError as e:
+    uproot = e  # Only needed for .py plugins.
+
 
 def log_unexpected_error_subprocess(logger, subprocess_return, add_context=""):
     logger.error(subprocess_return)
@@ -30,11 +41,41 @@ Timer = collections.namedtuple(
 )
 
 
+def add_histograms(total, h):
+    """Numpy histogram tuples (counts, *edges) or boost-histogram objects."""
+    if total is None:
+        return h
+    if isinstance(h, tuple):
+        return (total[0] + h[0],) + tuple(h[1:])
+    return total + h
+
+
 class MonitoringPlugins:
     _plugins_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plugins")
+    # Fills the histograms of several plugins in a single RDataFrame event loop.
+    _single_pass_macro = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "continuous_event_building",
+        "singlePassDecoration.C",
+    )
+    _single_pass_plugins = {"run": ["bugChecks", "fullSCA", "hitMaps", "hitMapsXY"]}
+    # .py plugins get the branches in chunks of this size (uproot's step_size).
+    python_step_size = "100 MB"
 
-    def __init__(self, input_file, logger=None, verbose=False):
+    def __init__(
+        self,
+        input_file,
+        logger=None,
+        verbose=False,
+        root_pool=None,
+        output_file=None,
+        single_pass=False,
+        n_threads=0,
+        max_workers=4,
+    ):
         self.input_file = os.path.abspath(input_file)
+        # Where the plugin outputs are collected. By default, in the input file.
+        self.output_file = None if output_file is None else os.path.abspath(output_file)
         if logger is None:
             self.logger = logging.getLogger(__file__)
             if verbose:
@@ -43,6 +84,12 @@ class MonitoringPlugins:
             self.logger = logger
         self._plugins = None
         self.times = []
+        # Optional: A RootInterpreterPool (continuous_event_building/root_pool.py).
+        self.root_pool = root_pool
+        self.single_pass = single_pass
+        self.n_threads = n_threads
+        # Independent plugins run at the same time, each into its own file.
+        self.max_workers = max_workers
 
     def _validate_plugins(self, new_plugins=None):
         """Currently does nothing."""
@@ -56,12 +103,15 @@ class MonitoringPlugins:
         if self._plugins is None:
             self._plugins = {}
             for plugin_level in os.listdir(self._plugins_dir):
+                if plugin_level == "__pycache__":
+                    continue
                 folder = os.path.join(self._plugins_dir, plugin_level)
                 assert os.path.isdir(folder), folder
                 self._plugins[plugin_level] = {}
                 for file_name in os.listdir(folder):
                     file_path = os.path.join(folder, file_name)
-                    assert os.path.isfile(file_path)
+                    if not os.path.isfile(file_path):
+                        continue  # E.g. a __pycache__, written by another import.
                     name, ext = os.path.splitext(file_name)
                     assert name not in self._plugins[plugin_level], name
                     self._plugins[plugin_level][name] = file_path
@@ -75,27 +125,101 @@ class MonitoringPlugins:
         self._plugins = value
 
     def shoot(self, input_file=None):
+        """All plugin outputs are added to the output file in one final step.
+
+        If any plugin fails, the output file is left untouched.
+        """
         if input_file is not None:
             self.input_file = os.path.abspath(input_file)
+        jobs = self._jobs()
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+            futures = [executor.submit(self._run_job, *job[:3]) for job in jobs]
+        outputs = [job[3] for job in jobs]
+        failed = [f.exception() for f in futures if f.exception() is not None]
+        if len(failed) or len(outputs) == 0:
+            for output in outputs:
+                if os.path.exists(output):
+                    os.remove(output)
+            if len(failed):
+                raise failed[0]
+            return
+        start_time = time.time()
+        output_file = self.output_file or self.input_file
+        ret = subprocess.run(
+            f"rootmv {' '.join(outputs)} {output_file}",
+            shell=True,
+            capture_output=True,
+        )
+        if ret.returncode != 0 or ret.stderr != b"":
+            log_unexpected_error_subprocess(self.logger, ret, " during rootmv")
+        self._add_timer("assemble", start_time, "all")
+
+    def _temporary_output(self, name):
+        output_file = self.output_file or self.input_file
+        return add_suffix_before_extension(output_file, "_" + name, ".root")
+
+    def _jobs(self):
+        """(name, plugin_level, function, output_file) per independent plugin job."""
+        jobs = []
         for plugin_level, plugins_per_level in self.plugins.items():
-            for name, plugin_path in plugins_per_level.items():
-                start_time = time.time()
-                self.logger.debug(
-                    f"🎄Decorate {name} (per-{plugin_level}) "
-                    f"on {os.path.basename(self.input_file)} "
-                    f"({plugin_path} on {self.input_file})."
+            covered = self._single_pass_plugins.get(plugin_level, [])
+            covered = [n for n in plugins_per_level if n in covered]
+            if self.single_pass and len(covered):
+                plugins_per_level = {
+                    k: v for k, v in plugins_per_level.items() if k not in covered
+                }
+                output = self._temporary_output("singlePassDecoration")
+                shoot = functools.partial(
+                    self._shoot_root,
+                    self._single_pass_macro,
+                    output,
+                    macro_args=(",".join(covered), self.n_threads),
+                )
+                jobs.append(("singlePassDecoration", plugin_level, shoot, output))
+            python_plugins = {
+                k: v for k, v in plugins_per_level.items() if v.endswith(".py")
+            }
+            if len(python_plugins) and isinstance(uproot, ImportError):
+                self.logger.warning(
+                    f"🎄Skip the .py plugins {', '.join(python_plugins)}: {uproot}"
                 )
-                self.shoot_by_name(plugin_path)
-                self.times.append(
-                    Timer(
-                        job_type=name,
-                        time=time.time() - start_time,
-                        timestamp=datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S"),
-                        id=plugin_level,
-                        worker=-1,
-                        data_path=self.input_file,
-                    )
+            elif len(python_plugins):
+                output = self._temporary_output("python_" + plugin_level)
+                shoot = functools.partial(
+                    self._shoot_python, python_plugins, plugin_level, output
                 )
+                # Timed per plugin in _shoot_python.
+                jobs.append((None, plugin_level, shoot, output))
+            for name, plugin_path in plugins_per_level.items():
+                if name in python_plugins:
+                    continue
+                output = self._temporary_output(name)
+                shoot = functools.partial(self._shoot_root, plugin_path, output)
+                jobs.append((name, plugin_level, shoot, output))
+        return jobs
+
+    def _run_job(self, name, plugin_level, shoot):
+        start_time = time.time()
+        if name is not None:
+            self.logger.debug(
+                f"🎄Decorate {name} (per-{plugin_level}) "
+                f"on {os.path.basename(self.input_file)}."
+            )
+        shoot()
+        if name is not None:
+            self._add_timer(name, start_time, plugin_level)
+
+    def _add_timer(self, job_type, start_time, plugin_level, duration=None):
+        self.times.append(
+            Timer(
+                job_type=job_type,
+                time=time.time() - start_time if duration is None else duration,
+                timestamp=datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S"),
+                id=plugin_level,
+                worker=-1,
+                data_path=self.input_file,
+            )
+        )
 
     def shoot_by_name(self, plugin_path, input_file=None):
         if input_file is not None:
@@ -104,10 +228,92 @@ class MonitoringPlugins:
         implementation_type = os.path.splitext(plugin_path)[-1]
         if implementation_type == ".C":
             self._shoot_root(plugin_path, input_file)
+        elif implementation_type == ".py":
+            name = os.path.splitext(os.path.basename(plugin_path))[0]
+            plugin_level = os.path.basename(os.path.dirname(plugin_path))
+            self._shoot_python({name: plugin_path}, plugin_level)
         else:
             raise NotImplementedError(implementation_type)
 
-    def _shoot_root(self, plugin_path, output_file=None):
+    @staticmethod
+    def _load_python_plugin(plugin_path):
+        """A .py plugin is a module with the attributes
+
+        - `branches`: The names of the ecal branches that the plugin needs.
+        - `fill(arrays)`: Receives the requested branches as awkward arrays (by
+          name). Returns `{histogram_name: histogram}`, with numpy histograms
+          (`np.histogram`/`np.histogram2d` tuples) or boost-histogram objects.
+          Called once per chunk of events: The histograms are added up, so their
+          binning must not depend on the data.
+        - `directory` (optional): Where the histograms are written. By default,
+          a directory with the plugin's name.
+        """
+        name = os.path.splitext(os.path.basename(plugin_path))[0]
+        spec = importlib.util.spec_from_file_location(f"plugin_{name}", plugin_path)
+        module = importlib.util.module_from_spec(spec)
+        dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = True  # No __pycache__ among the plugins.
+        try:
+            spec.loader.exec_module(module)
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+        assert hasattr(module, "branches"), f"{plugin_path} must define `branches`."
+        assert callable(getattr(module, "fill", None)), f"{plugin_path} needs `fill`."
+        if not hasattr(module, "directory"):
+            module.directory = name
+        return module
+
+    def _ecal_trees(self):
+        """`{file_path: "ecal"}` for uproot."""
+        with uproot.open(self.input_file) as f:
+            if "ecal_segments" in f:
+                # The snapshot only holds a TChain (see chainSegments.C).
+                segments = f["ecal_segments"].member("fTitle").splitlines()
+                return {segment: "ecal" for segment in segments}
+        return {self.input_file: "ecal"}
+
+    def _shoot_python(self, python_plugins, plugin_level, output_file=None):
+        """All .py plugins share the branches, that are read only once.
+
+        The branches are read in chunks: The whole run never has to fit in memory.
+        """
+        if isinstance(uproot, ImportError):
+            raise uproot
+        modules = {k: self._load_python_plugin(v) for k, v in python_plugins.items()}
+        branches = sorted({b for m in modules.values() for b in m.branches})
+        self.logger.debug(
+            f"🎄Read {', '.join(branches)} for {', '.join(modules)} "
+            f"(per-{plugin_level}) from {os.path.basename(self.input_file)}."
+        )
+        chunks = uproot.iterate(
+            self._ecal_trees(), branches, step_size=self.python_step_size
+        )
+        durations = collections.Counter()
+        histograms = {}
+        while True:
+            start_time = time.time()
+            arrays = next(chunks, None)
+            durations["read_branches"] += time.time() - start_time
+            if arrays is None:
+                break
+            for name, module in modules.items():
+                start_time = time.time()
+                for h_name, h in module.fill(
+                    {b: arrays[b] for b in module.branches}
+                ).items():
+                    path = f"{module.directory}/{h_name}"
+                    histograms[path] = add_histograms(histograms.get(path), h)
+                durations[name] += time.time() - start_time
+        for job_type, duration in durations.items():
+            self._add_timer(job_type, None, plugin_level, duration)
+        if output_file is None:
+            output_file = self.output_file or self.input_file
+        open_file = uproot.update if os.path.exists(output_file) else uproot.recreate
+        with open_file(output_file) as f:
+            for path, h in histograms.items():
+                f[path] = h
+
+    def _shoot_root(self, plugin_path, output_file=None, macro_args=()):
         if output_file is None:
             name = os.path.splitext(os.path.basename(plugin_path))[0]
             macro_output = add_suffix_before_extension(
@@ -116,19 +322,32 @@ class MonitoringPlugins:
         else:
             macro_output = output_file
         assert not os.path.exists(macro_output), macro_output
-        macro = os.path.basename(plugin_path)
-        root_call = f'"{macro}(\\"{self.input_file}\\", \\"{macro_output}\\")"'
-        ret = subprocess.run(
-            "root -b -l -q " + root_call,
-            shell=True,
-            capture_output=True,
-            cwd=os.path.dirname(plugin_path),
-        )
+        if self.root_pool is None:
+            macro = os.path.basename(plugin_path)
+            cpp_args = [f'\\"{self.input_file}\\"', f'\\"{macro_output}\\"']
+            for arg in macro_args:
+                cpp_args.append(str(arg) if isinstance(arg, int) else f'\\"{arg}\\"')
+            root_call = f'"{macro}({", ".join(cpp_args)})"'
+            ret = subprocess.run(
+                "root -b -l -q " + root_call,
+                shell=True,
+                capture_output=True,
+                cwd=os.path.dirname(plugin_path),
+            )
+        else:
+            ret = self.root_pool.run(
+                plugin_path,
+                self.input_file,
+                macro_output,
+                *macro_args,
+                data_path=self.input_file,
+            )
         if ret.returncode != 0 or ret.stderr != b"":
             log_unexpected_error_subprocess(self.logger, ret, f" during {plugin_path}")
         if output_file is None:
+            output_file = self.output_file or self.input_file
             ret = subprocess.run(
-                f"rootmv {macro_output} {self.input_file}",
+                f"rootmv {macro_output} {output_file}",
                 shell=True,
                 capture_output=True,
             )
@@ -159,6 +378,112 @@ class MonitoringPlugins:
             f.write("\n".join(lines) + "\n")
 
 
+class PartDecorations:
+    """Decorate each build part once. A snapshot gets the sum of these outputs.
+
+    All plugin histograms are counts with unit-width bins centred on integers (or
+    fixed bins). `hadd` (`TH1::Merge`) adds up parts with different axis ranges
+    by extending the axes: Each part only spans its own range. The sum over all
+    decorated parts is kept up to date in `cache_dir`: A snapshot only pays for
+    the parts that are new since the previous one.
+    """
+
+    sum_name = "decoration_sum.root"
+    summed_parts_name = "decoration_sum.txt"
+
+    def __init__(self, cache_dir, logger=None, **plugin_kwargs):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.mkdir(cache_dir)
+        self.logger = logger if logger is not None else logging.getLogger(__file__)
+        self.plugin_kwargs = plugin_kwargs
+        self.times = []
+        # Snapshots might be taken concurrently: One update of the sum at a time.
+        self._update_lock = threading.Lock()
+        self.sum_path = os.path.join(cache_dir, self.sum_name)
+        self._summed_parts_path = os.path.join(cache_dir, self.summed_parts_name)
+        self._summed_parts = []
+        if os.path.exists(self._summed_parts_path) and os.path.exists(self.sum_path):
+            with open(self._summed_parts_path) as f:
+                self._summed_parts = f.read().split()
+
+    def cache_path(self, build_part):
+        return os.path.join(self.cache_dir, os.path.basename(build_part))
+
+    def _decorate_part(self, build_part):
+        cache_path = self.cache_path(build_part)
+        if os.path.exists(cache_path):
+            return cache_path
+        tmp_path = add_suffix_before_extension(cache_path, "_tmp")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)  # From an interrupted earlier attempt.
+        mps = MonitoringPlugins(
+            build_part,
+            logger=self.logger,
+            output_file=tmp_path,
+            **self.plugin_kwargs,
+        )
+        mps.shoot()
+        self.times.extend(mps.times)
+        os.rename(tmp_path, cache_path)
+        return cache_path
+
+    def update(self, build_parts):
+        """Decorate the new build parts and add them to the sum."""
+        with self._update_lock:
+            self._update(build_parts)
+
+    def _update(self, build_parts):
+        summed = set(self._summed_parts)
+        new_parts = [p for p in build_parts if os.path.basename(p) not in summed]
+        if len(new_parts) == 0:
+            return
+        start_time = time.time()
+        new_caches = [self._decorate_part(p) for p in new_parts]
+        to_add = new_caches
+        if os.path.exists(self.sum_path):
+            to_add = [self.sum_path] + new_caches
+        tmp_sum = add_suffix_before_extension(self.sum_path, "_tmp")
+        ret = subprocess.run(
+            f"hadd -f {tmp_sum} {' '.join(to_add)}",
+            shell=True,
+            capture_output=True,
+        )
+        if ret.returncode != 0:
+            log_unexpected_error_subprocess(self.logger, ret, " during hadd")
+            sys.exit(1)
+        os.replace(tmp_sum, self.sum_path)
+        self._summed_parts.extend(os.path.basename(p) for p in new_parts)
+        with open(self._summed_parts_path + ".tmp", "w") as f:
+            f.write("".join(p + "\n" for p in self._summed_parts))
+        os.replace(self._summed_parts_path + ".tmp", self._summed_parts_path)
+        self.times.append(
+            Timer(
+                job_type="update_decoration_sum",
+                time=time.time() - start_time,
+                timestamp=datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S"),
+                id=len(new_parts),
+                worker=-1,
+                data_path=self.sum_path,
+            )
+        )
+
+    def add_to(self, output_file):
+        """Move a copy of the summed decoration into the output file."""
+        if not os.path.exists(self.sum_path):
+            return
+        if not os.path.exists(output_file):
+            shutil.copy(self.sum_path, output_file)
+            return
+        tmp_copy = add_suffix_before_extension(output_file, "_decoration_sum")
+        shutil.copy(self.sum_path, tmp_copy)
+        ret = subprocess.run(
+            f"rootmv {tmp_copy} {output_file}", shell=True, capture_output=True
+        )
+        if ret.returncode != 0 or ret.stderr != b"":
+            log_unexpected_error_subprocess(self.logger, ret, " during rootmv")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Take a monitoring snapshot.",
@@ -166,8 +491,37 @@ if __name__ == "__main__":
     parser.add_argument("input_file")
     parser.add_argument("--verbose", action="store_true")
     parser.add_argument("--times_file", default=None)
+    parser.add_argument(
+        "--output_file",
+        default=None,
+        help="Collect the plugin outputs here instead of in the input_file.",
+    )
+    parser.add_argument(
+        "--single_pass",
+        action="store_true",
+        help="Fill the histograms of the known plugins in one RDataFrame loop.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="For --single_pass. 0: All cores.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of plugins that run at the same time.",
+    )
     args = parser.parse_args()
-    mps = MonitoringPlugins(args.input_file, verbose=args.verbose)
+    mps = MonitoringPlugins(
+        args.input_file,
+        verbose=args.verbose,
+        output_file=args.output_file,
+        single_pass=args.single_pass,
+        n_threads=args.threads,
+        max_workers=args.workers,
+    )
     mps.shoot()
     if args.times_file is not None:
         if not os.path.isdir(os.path.dirname(args.times_file)):
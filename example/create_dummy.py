@@ -1,11 +1,18 @@
 #!/usr/bin/env python
 import argparse
+import concurrent.futures
 import itertools
 import os
 import random
 import sys
 
-random.seed(202203)
+try:
+    import numpy as np
+except ImportError as e:
+    np = e
+
+default_seed = 202203
+random.seed(default_seed)
 
 PrototypeDimensions = {
     "n_slab": 15,
@@ -35,6 +42,13 @@ dat_header = """
 ============ Channel (unsigned char) LowValue (unsigned short) LowHitFlag (unsigned char) LowGainFlag (unsigned char) HighValue (unsigned short) HighHitFlag (unsigned char) HighGainFlag (unsigned char) ============
 """  # noqa
 
+dat_chip_header = (
+    "#{i} Size {size} ChipID {chip} coreIdx 0 slabIdx {slab} slabAdd {slab} "
+    "Asu 0 SkirocIndex {chip} transmitID 0 cycleID {cycle_id} "
+    "StartTime 54578 rawTSD 3692 rawAVDD0 2039 rawAVDD1 2039 tsdValue 33.02 "
+    "avDD0 1.993 aVDD1 1.993"
+)
+
 
 def pedestal(file_path, dims=PrototypeDimensions):
     lines = []
@@ -161,15 +175,7 @@ def _random_nsca_filled():
     return max(1, int(random.gammavariate(0.5, 8)))
 
 
-def dat(
-    file_path, i_shift=0, dims=PrototypeDimensions, n_dat_entries=10000, cycle_id=0
-):
-    chip_header = (
-        "#{i} Size {size} ChipID {chip} coreIdx 0 slabIdx {slab} slabAdd {slab} "
-        "Asu 0 SkirocIndex {chip} transmitID 0 cycleID {cycle_id} "
-        "StartTime 54578 rawTSD 3692 rawAVDD0 2039 rawAVDD1 2039 tsdValue 33.02 "
-        "avDD0 1.993 aVDD1 1.993"
-    )
+def _dat_header_lines(dims=PrototypeDimensions):
     dat_slab_lines = "\n".join(
         map(
             (
@@ -179,7 +185,14 @@ def dat(
             range(dims["n_slab"]),
         )
     )
-    lines = dat_header.format(DAT_SLAB_LINES=dat_slab_lines).split("\n")[1:-1]
+    return dat_header.format(DAT_SLAB_LINES=dat_slab_lines).split("\n")[1:-1]
+
+
+def dat(
+    file_path, i_shift=0, dims=PrototypeDimensions, n_dat_entries=10000, cycle_id=0
+):
+    chip_header = dat_chip_header
+    lines = _dat_header_lines(dims)
     bcid = 0
     mip_signal_channel = 22
     kw = {}
@@ -227,6 +240,185 @@ def dat(
     return kw["cycle_id"]
 
 
+class _Draws:
+    """Single draws from a numpy generator, which is called in blocks.
+
+    `draw(n)` returns an array of n values.
+    """
+
+    def __init__(self, draw, block_size=4096):
+        self._draw = draw
+        self._block_size = block_size
+        self._values = []
+
+    def __call__(self):
+        if not self._values:
+            self._values = self._draw(self._block_size).tolist()[::-1]
+        return self._values.pop()
+
+
+def _part_rngs(seed, i_dat):
+    """Independent streams per part: for the readout sequence and for the hits."""
+    return [np.random.default_rng([seed, i_dat, stream]) for stream in [0, 1]]
+
+
+def _plan_dat(i_shift, dims, n_dat_entries, seed):
+    """The chip readouts of a `.dat` file, in the same sequence as in `dat`.
+
+    Returns the readouts as (i, chip, slab, relative cycle, bcid, n_sca, signal
+    channel) and the last relative cycle. Only uses the first stream of the part,
+    so that the cycles of all parts are known before any hits are drawn.
+    """
+    rng = _part_rngs(seed, i_shift)[0]
+    uniform = _Draws(rng.random)
+    # As in `_random_nsca_filled`.
+    n_sca_filled = _Draws(lambda n: np.maximum(1, rng.gamma(0.5, 8, n).astype(int)))
+    mip_signal_channel = 22
+    readouts = []
+    chips_to_write = {}
+    bcid = 0
+    cycle = 1
+    i = i_shift * n_dat_entries
+    i_end = (i_shift + 1) * n_dat_entries
+    while i < i_end:
+        bcid = bcid + int(uniform() * 8 * (1 + 100 * (uniform() < 0.95)))
+        if uniform() < 0.005:
+            for slab in range(dims["n_slab"]):
+                n_sca = n_sca_filled() + 1
+                chip_readout = (i, 0, slab, cycle, bcid, n_sca, mip_signal_channel)
+                chips_to_write[(slab, 0)] = chip_readout
+                i = i + 1
+            cycle = cycle + 1
+            readouts.extend(chips_to_write.values())
+            chips_to_write = {}
+        else:
+            n_sca = n_sca_filled()
+            chip = int(uniform() * dims["n_chip"])
+            slab = int(uniform() * dims["n_slab"])
+            if (slab, chip) not in chips_to_write:
+                chip_readout = (i, chip, slab, cycle, bcid, n_sca, None)
+                chips_to_write[(slab, chip)] = chip_readout
+                i = i + 1
+            if uniform() < 0.15:
+                cycle = cycle + 1
+                readouts.extend(chips_to_write.values())
+                chips_to_write = {}
+    return readouts, cycle
+
+
+def fast_dat(
+    file_path,
+    i_shift=0,
+    dims=PrototypeDimensions,
+    n_dat_entries=10000,
+    cycle_offset=0,
+    seed=default_seed,
+):
+    """Same format as `dat`, but the hits are drawn with numpy in bulk.
+
+    The content is fixed by `seed` and `i_shift` alone. `cycle_offset` is the
+    sum of the last relative cycles of the previous parts (see `cycle_offsets`).
+    """
+    readouts, _ = _plan_dat(i_shift, dims, n_dat_entries, seed)
+    rng = _part_rngs(seed, i_shift)[1]
+    n_attempts = sum(readout[5] for readout in readouts)
+    u_step = rng.random((2, n_attempts))
+    bcid_steps = (u_step[0] * 8 * (1 + 100 * (u_step[1] < 0.95))).astype(int)
+    bcid_steps = bcid_steps.tolist()
+    rand_chans = rng.integers(0, dims["n_channel"], n_attempts).tolist()
+    # At most one hit per attempt, plus the signal channels.
+    sig = rng.normal(200, 40, n_attempts + len(readouts))
+    low_gain = (250 + sig / 10).astype(int).tolist()
+    high_gain = (250 + sig).astype(int).tolist()
+    # The channel block of an SCA is cut from the block without hits.
+    empty_block = "".join(
+        f"Ch {i} LG 250 0 0 HG 250 0 0\n" for i in range(dims["n_channel"])
+    )
+    line_starts = [0]
+    for line in empty_block.splitlines(keepends=True):
+        line_starts.append(line_starts[-1] + len(line))
+    lines = _dat_header_lines(dims)
+    i_attempt = 0
+    i_hit = 0
+    for i, chip, slab, cycle, bcid, n_sca, signal_channel in readouts:
+        bcid_chan = {}
+        for _ in range(n_sca):
+            new_bcid = bcid + bcid_steps[i_attempt]
+            bcid_chan.setdefault(new_bcid, []).append(rand_chans[i_attempt])
+            i_attempt = i_attempt + 1
+        if signal_channel is not None:
+            bcid_chan.setdefault(bcid, []).append(signal_channel)
+        if len(bcid_chan) > dims["n_sca"]:
+            bcid_chan = {}  # As in `_chip_lines`.
+        lines.append(
+            dat_chip_header.format(
+                i=i,
+                size=len(bcid_chan),
+                chip=chip,
+                slab=slab,
+                cycle_id=cycle + cycle_offset,
+            )
+        )
+        for i_sca, sca_bcid in enumerate(sorted(bcid_chan)):
+            sca = len(bcid_chan) - i_sca - 1
+            lines.append(f"##{i_sca} BCID {sca_bcid % 4096} SCA {sca} #Hits 1")
+            hits = {}
+            for ch in bcid_chan[sca_bcid]:
+                # As in `_channel_lines`, a repeated channel keeps its first value.
+                hits.setdefault(ch, (low_gain[i_hit], high_gain[i_hit]))
+                i_hit = i_hit + 1
+            block = []
+            i_channel = 0
+            for ch, (lg, hg) in sorted(hits.items()):
+                block.append(empty_block[line_starts[i_channel] : line_starts[ch]])
+                block.append(f"Ch {ch} LG {lg} 1 0 HG {hg} 1 0\n")
+                i_channel = ch + 1
+            block.append(empty_block[line_starts[i_channel] :])
+            lines.append("".join(block)[:-1])
+    lines.append("")
+    with open(file_path, "w", buffering=2**20) as f:
+        f.write("\n".join(lines))
+
+
+def _last_cycle(i_shift, dims, n_dat_entries, seed):
+    return _plan_dat(i_shift, dims, n_dat_entries, seed)[1]
+
+
+def cycle_offsets(
+    n_dat, dims=PrototypeDimensions, n_dat_entries=10000, seed=default_seed, mapper=map
+):
+    """The `cycle_offset` of each part, for continuous cycles as with `dat`."""
+    last_cycles = mapper(
+        _last_cycle,
+        range(n_dat),
+        [dims] * n_dat,
+        [n_dat_entries] * n_dat,
+        [seed] * n_dat,
+    )
+    return list(itertools.accumulate(last_cycles, initial=0))[:-1]
+
+
+def fast_dats(
+    run_dir,
+    n_dat,
+    dims=PrototypeDimensions,
+    n_dat_entries=10000,
+    seed=default_seed,
+    n_processes=None,
+):
+    """All `.dat` files of the dummy run, spread over a process pool."""
+    run_name = os.path.basename(os.path.normpath(run_dir))
+    with concurrent.futures.ProcessPoolExecutor(n_processes) as executor:
+        offsets = cycle_offsets(n_dat, dims, n_dat_entries, seed, executor.map)
+        futures = []
+        for i_dat in range(n_dat):
+            file_path = os.path.join(run_dir, f"{run_name}.dat_{i_dat:04}")
+            args = [file_path, i_dat, dims, n_dat_entries, offsets[i_dat], seed]
+            futures.append(executor.submit(fast_dat, *args))
+        for future in concurrent.futures.as_completed(futures):
+            future.result()  # Raise the exceptions of the workers.
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Create dummy data and configuration for code testing.",
@@ -238,7 +430,16 @@ if __name__ == "__main__":
     help = "A real .dat_XXXX file has 10000 entries. "
     help += "Less entries but more files is better for testing the monitoring."
     parser.add_argument("--n_dat_entries", default=1000, type=int, help=help)
+    parser.add_argument("--seed", default=default_seed, type=int)
+    help = "Draw the hits with numpy in bulk and write the .dat files in parallel. "
+    help += "Same format, but not the same hits as without --fast."
+    parser.add_argument("--fast", action="store_true", help=help)
+    help = "Processes for --fast (default: one per CPU)."
+    parser.add_argument("--n_processes", type=int, help=help)
     args = parser.parse_args()
+    if args.fast and isinstance(np, ImportError):
+        raise np
+    random.seed(args.seed)
     dims = {}
     for dim in PrototypeDimensions:
         dims[dim] = getattr(args, dim)
@@ -258,14 +459,24 @@ if __name__ == "__main__":
         if not os.path.exists(dummy_run_dir):
             os.makedirs(dummy_run_dir)
         run_settings(os.path.join(dummy_run_dir, "Run_Settings.txt"), dims)
-        cycle_id = 0
-        for i_dat in range(args.n_dat):
-            name = f"dummy_run_123456.dat_{i_dat:04}"
-            cycle_id = dat(
-                os.path.join(dummy_run_dir, name),
-                i_dat,
+        if args.fast:
+            fast_dats(
+                dummy_run_dir,
+                args.n_dat,
                 dims,
                 args.n_dat_entries,
-                cycle_id,
+                args.seed,
+                args.n_processes,
             )
+        else:
+            cycle_id = 0
+            for i_dat in range(args.n_dat):
+                name = f"dummy_run_123456.dat_{i_dat:04}"
+                cycle_id = dat(
+                    os.path.join(dummy_run_dir, name),
+                    i_dat,
+                    dims,
+                    args.n_dat_entries,
+                    cycle_id,
+                )
         open(os.path.join(dummy_run_dir, "hitsHistogram.txt"), "w").close()
@@ -0,0 +1,20 @@
+"""Hits per layer, as an example of a .py plugin (see `_load_python_plugin`).
+
+Not active by default: Copy it into plugins/run/ to decorate with it (needs uproot).
+"""
+import awkward as ak
+import numpy as np
+
+branches = ["hit_slab", "hit_isHit", "nhit_slab"]
+directory = "hits_per_slab"
+
+# Fixed binning: The chunks (and the outputs for different build parts) add up.
+_slab_edges = np.arange(31) - 0.5
+
+
+def fill(arrays):
+    hit_slab = ak.flatten(arrays["hit_slab"][arrays["hit_isHit"] == 1])
+    return {
+        "hitsPerSlab": np.histogram(np.asarray(hit_slab), bins=_slab_edges),
+        "nhitSlab": np.histogram(np.asarray(arrays["nhit_slab"]), bins=_slab_edges),
+    }
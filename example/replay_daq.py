@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""Replay the file output of the DAQ into a run folder, with a realistic timing.
+
+The parts appear one after the other, like during data taking: `Run_Settings.txt`
+first, then the first part without number (`run.dat` or `run_raw.bin`), then the
+numbered parts, and `hitsHistogram.txt` once the run is over. Each part is
+written progressively over its time slot, so that the newest part is still open
+while it grows. With `--tar`, each part is compressed and moved into the run
+folder as a whole at the end of its slot instead.
+
+The parts are either synthetic (from `create_dummy.py`, generated ahead of time
+on a process pool) or copied from a recorded run. The pace is a target data
+rate (`--mb_s`), a number of parts per minute (`--parts_per_minute`), or, for a
+recorded run, the original time between the files (from their mtimes).
+
+Start `start_monitoring_run.py` on the run folder to see whether it keeps up.
+"""
+import argparse
+import collections
+import concurrent.futures
+import os
+import re
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+import create_dummy
+
+Part = collections.namedtuple("Part", ["name", "path", "duration"])
+
+_numbered_part = re.compile(r"(\.dat|_raw\.bin.*)_(?P<id>[0-9]{4})(\.tar\.gz)?$")
+_first_part = re.compile(r"(\.dat|_raw\.bin)(\.tar\.gz)?$")
+_chunk_size = 1024**2
+
+
+def without_tar(name):
+    if name.endswith(".tar.gz"):
+        name = name[: -len(".tar.gz")]
+    return name
+
+
+def daq_part_name(run_name, i_part, extension=".dat"):
+    """As named by the DAQ: The first part has no number."""
+    if i_part == 0:
+        return run_name + extension
+    return f"{run_name}{extension}_{i_part:04}"
+
+
+def sleep_until(timestamp):
+    time.sleep(max(0, timestamp - time.time()))
+
+
+def run_file_path(run_folder, name):
+    """The path of a run file, possibly compressed. None if it does not exist."""
+    for candidate in [name, name + ".tar.gz"]:
+        path = os.path.join(run_folder, candidate)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def recorded_parts(run_folder, speed=1):
+    """The parts of a recorded run, with the time between their mtimes.
+
+    Also returns the paths of the run settings and of `hitsHistogram.txt`, and the
+    time between the last part and `hitsHistogram.txt` (or None).
+    """
+    parts = {}
+    for name in os.listdir(run_folder):
+        match = _numbered_part.search(name)
+        if match:
+            parts[int(match.group("id"))] = name
+        elif _first_part.search(name):
+            parts[0] = name
+    if len(parts) == 0:
+        raise FileNotFoundError(f"No .dat or _raw.bin parts in {run_folder}.")
+    settings = run_file_path(run_folder, "Run_Settings.txt")
+    hits_histogram = run_file_path(run_folder, "hitsHistogram.txt")
+    previous_mtime = None if settings is None else os.path.getmtime(settings)
+    replay = []
+    for i_part in sorted(parts):
+        path = os.path.join(run_folder, parts[i_part])
+        mtime = os.path.getmtime(path)
+        if previous_mtime is None:
+            previous_mtime = mtime
+        replay.append(Part(parts[i_part], path, max(0, mtime - previous_mtime) / speed))
+        previous_mtime = mtime
+    hits_delay = None
+    if hits_histogram is not None:
+        hits_delay = max(0, os.path.getmtime(hits_histogram) - previous_mtime) / speed
+    return replay, settings, hits_histogram, hits_delay
+
+
+def synthetic_parts(run_name, staging_dir, executor, n_processes, args):
+    """Generate the .dat parts ahead of time, yield them in order once ready."""
+    dims = create_dummy.PrototypeDimensions
+    offsets = create_dummy.cycle_offsets(
+        args.n_parts, dims, args.n_dat_entries, args.seed, executor.map
+    )
+    lookahead = 2 * n_processes
+    futures = {}
+    for i_part in range(args.n_parts):
+        for i_ahead in range(i_part, min(i_part + lookahead, args.n_parts)):
+            if i_ahead in futures:
+                continue
+            name = daq_part_name(run_name, i_ahead)
+            path = os.path.join(staging_dir, name)
+            futures[i_ahead] = (name, path), executor.submit(
+                create_dummy.fast_dat,
+                path,
+                i_ahead,
+                dims,
+                args.n_dat_entries,
+                offsets[i_ahead],
+                args.seed,
+            )
+        (name, path), future = futures.pop(i_part)
+        future.result()
+        yield Part(name, path, None)
+        os.remove(path)
+
+
+class Pacer:
+    """The time slot of each part: From the data rate, parts/minute or recording."""
+
+    def __init__(self, mb_s=None, parts_per_minute=None):
+        self._mb_s = mb_s
+        self._parts_per_minute = parts_per_minute
+
+    def duration(self, part):
+        if self._mb_s:
+            return os.path.getsize(part.path) / (self._mb_s * 1e6)
+        if self._parts_per_minute:
+            return 60 / self._parts_per_minute
+        return part.duration or 0
+
+
+def write_paced(src_path, dst_path, start_time, end_time):
+    """Copy in chunks, at the pace that finishes the file at `end_time`."""
+    size = max(1, os.path.getsize(src_path))
+    written = 0
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        while True:
+            chunk = src.read(_chunk_size)
+            if not chunk:
+                break
+            dst.write(chunk)
+            dst.flush()
+            written += len(chunk)
+            sleep_until(start_time + (end_time - start_time) * written / size)
+    sleep_until(end_time)
+
+
+def move_in_at(src_path, dst_path, end_time, compress):
+    """Prepare the (compressed) part under a hidden name, rename it at `end_time`.
+
+    The hidden name does not match the part patterns of the monitoring.
+    """
+    tmp_path = os.path.join(
+        os.path.dirname(dst_path), "." + os.path.basename(dst_path) + ".tmp"
+    )
+    if compress:
+        with tarfile.open(tmp_path, "w:gz") as tar:
+            tar.add(src_path, arcname=without_tar(os.path.basename(dst_path)))
+    else:
+        shutil.copyfile(src_path, tmp_path)
+    sleep_until(end_time)
+    os.replace(tmp_path, dst_path)
+
+
+def deliver(part, run_folder, start_time, end_time, tar=False):
+    """Write (or move) the part into the run folder by `end_time`."""
+    if part.path.endswith(".tar.gz"):
+        dst_path = os.path.join(run_folder, part.name)
+        move_in_at(part.path, dst_path, end_time, compress=False)
+    elif tar:
+        dst_path = os.path.join(run_folder, part.name + ".tar.gz")
+        move_in_at(part.path, dst_path, end_time, compress=True)
+    else:
+        dst_path = os.path.join(run_folder, part.name)
+        write_paced(part.path, dst_path, start_time, end_time)
+
+
+def replay(parts, run_folder, pacer, tar=False):
+    """Deliver the parts on schedule. A late part shifts the following slots."""
+    start_time = time.time()
+    end_time = start_time
+    behind_schedule = 0
+    n_parts = 0
+    n_bytes = 0
+    for part in parts:
+        open_time = time.time()
+        if open_time > end_time:
+            behind_schedule += open_time - end_time
+        else:
+            open_time = end_time
+        end_time = open_time + pacer.duration(part)
+        part_bytes = os.path.getsize(part.path)  # Before a compression.
+        deliver(part, run_folder, open_time, end_time, tar)
+        n_parts += 1
+        n_bytes += part_bytes
+        print(f"📤{part.name}: {part_bytes / 1e6:.1f} MB, {n_parts} parts so far.")
+    elapsed = max(time.time() - start_time, 1e-9)
+    print(
+        f"🏁{n_parts} parts, {n_bytes / 1e6:.1f} MB in {elapsed:.1f}s: "
+        f"{n_bytes / 1e6 / elapsed:.2f} MB/s, {60 * n_parts / elapsed:.1f} parts/min."
+    )
+    if behind_schedule > 1:
+        print(
+            f"🐌The replay fell {behind_schedule:.1f}s behind the target pace. "
+            "More --n_processes or a lower rate might help."
+        )
+    return end_time
+
+
+def main(args):
+    run_folder = os.path.abspath(args.run_folder)
+    if os.path.exists(run_folder) and os.listdir(run_folder):
+        sys.exit(f"The run folder {run_folder} is not empty.")
+    os.makedirs(run_folder, exist_ok=True)
+    run_name = os.path.basename(run_folder)
+    pacer = Pacer(args.mb_s, args.parts_per_minute)
+    hits_path = os.path.join(run_folder, "hitsHistogram.txt")
+    if args.from_run:
+        parts, settings, hits_source, hits_delay = recorded_parts(
+            args.from_run, args.speed
+        )
+        if settings is not None:
+            shutil.copyfile(
+                settings, os.path.join(run_folder, os.path.basename(settings))
+            )
+        end_time = replay(parts, run_folder, pacer, args.tar)
+        if hits_source is not None:
+            if hits_delay is not None and not (args.mb_s or args.parts_per_minute):
+                sleep_until(end_time + hits_delay)
+            hits_path = os.path.join(run_folder, os.path.basename(hits_source))
+            shutil.copyfile(hits_source, hits_path)
+        else:
+            open(hits_path, "w").close()
+    else:
+        if isinstance(create_dummy.np, ImportError):
+            raise create_dummy.np
+        n_processes = args.n_processes or os.cpu_count()
+        create_dummy.run_settings(os.path.join(run_folder, "Run_Settings.txt"))
+        with tempfile.TemporaryDirectory(prefix="replay_daq_") as staging_dir:
+            with concurrent.futures.ProcessPoolExecutor(n_processes) as executor:
+                parts = synthetic_parts(
+                    run_name, staging_dir, executor, n_processes, args
+                )
+                replay(parts, run_folder, pacer, args.tar)
+        open(hits_path, "w").close()
+    print(f"🛑The run has finished: {hits_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write DAQ parts into a run folder at a configurable pace.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("run_folder", help="Created. Must not contain files yet.")
+    pace = parser.add_mutually_exclusive_group()
+    pace.add_argument("--mb_s", type=float, help="Target data rate in MB/s.")
+    pace.add_argument("--parts_per_minute", type=float)
+    help = "Replay the parts of this recorded run (default: synthetic .dat parts). "
+    help += "Without a target pace, the original time between the files is kept."
+    parser.add_argument("--from_run", help=help)
+    parser.add_argument(
+        "--speed", type=float, default=1, help="Speed-up of the recorded timing."
+    )
+    parser.add_argument(
+        "--tar", action="store_true", help="Deliver the parts as .tar.gz archives."
+    )
+    parser.add_argument("--n_parts", type=int, default=40, help="Synthetic parts.")
+    parser.add_argument("--n_dat_entries", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=create_dummy.default_seed)
+    help = "Processes that generate the synthetic parts (default: one per CPU)."
+    parser.add_argument("--n_processes", type=int, help=help)
+    main(parser.parse_args())
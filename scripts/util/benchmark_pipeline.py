@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""Throughput benchmark of the monitoring loop, without ROOT.
+
+Runs `EcalMonitoring.start_loop` on synthetic runs of several sizes and with
+several worker counts. The ROOT steps (conversion, event building, merging,
+decoration) are replaced by stubs that write files of a fixed size and take a
+configurable time (sleeping, or burning CPU with `--cpu`). Everything else, the
+job scheduling, journal, snapshots and file handling, is the real code.
+
+Per scenario, the benchmark reports
+- parts/s: raw parts per second of LOOP time (setup and wrap-up excluded),
+- overhead/job: LOOK_FOR_JOB time per job (incl. waiting for a job),
+- idle: fraction of the worker time (LOOP time * workers) not spent in jobs.
+
+With `--save_baseline`, these numbers are stored in a json file. With
+`--baseline`, the script fails if a scenario got slower than its baseline.
+"""
+import argparse
+import configparser
+import contextlib
+import importlib.util
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+dirname = os.path.dirname
+repo_root = dirname(dirname(dirname(os.path.abspath(__file__))))
+_spec = importlib.util.spec_from_file_location(
+    "start_monitoring_run", os.path.join(repo_root, "start_monitoring_run.py")
+)
+start_monitoring_run = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(start_monitoring_run)
+my_paths = start_monitoring_run.my_paths
+Priority = start_monitoring_run.Priority
+
+
+class StubCosts:
+    """Seconds per stub step. The merge and decoration costs are per part."""
+
+    def __init__(self, convert=0.05, build=0.1, merge=0.01, decorate=0.01, cpu=False):
+        self.convert = convert
+        self.build = build
+        self.merge = merge
+        self.decorate = decorate
+        self.cpu = cpu
+
+    def work(self, seconds):
+        if not self.cpu:
+            time.sleep(seconds)
+            return
+        end_time = time.perf_counter() + seconds
+        while time.perf_counter() < end_time:
+            pass
+
+
+def write_part(path, n_bytes):
+    with open(path, "wb") as f:
+        f.write(b"\0" * n_bytes)
+
+
+def completed(args):
+    return subprocess.CompletedProcess(args=args, returncode=0, stdout=b"", stderr=b"")
+
+
+class StubEventBuildingPool:
+    def __init__(self, costs, part_bytes):
+        self._costs = costs
+        self._part_bytes = part_bytes
+
+    def build(self, cli_args):
+        build_path = cli_args[cli_args.index("--build_path") + 1]
+        self._costs.work(self._costs.build)
+        write_part(build_path, self._part_bytes)
+        return completed(cli_args)
+
+    def close(self):
+        pass
+
+
+class StubPartDecorations:
+    def __init__(self, costs):
+        self._costs = costs
+        self._decorated = set()
+        self.times = []
+
+    def update(self, build_parts):
+        new_parts = set(build_parts) - self._decorated
+        self._costs.work(self._costs.decorate * len(new_parts))
+        self._decorated.update(new_parts)
+
+    def add_to(self, output_file):
+        pass
+
+
+class BenchmarkMonitoring(start_monitoring_run.EcalMonitoring):
+    """The monitoring loop, with stubs instead of the ROOT steps."""
+
+    def __init__(self, raw_run_folder, config_file, costs, part_bytes):
+        self._costs = costs
+        self._part_bytes = part_bytes
+        super().__init__(raw_run_folder, config_file)
+
+    def _validate_computing_environment(self):
+        pass
+
+    def create_masking(self):
+        return None
+
+    def _run_root_macro(self, macro_dir, macro, *args):
+        if macro in ["ConvertDataSL.cc", "RawConvertDataSL.cc"]:
+            self._costs.work(self._costs.convert)
+            write_part(args[2], self._part_bytes)
+        elif macro == "mergeSelective.C":
+            current_build, parts_arg = args[:2]
+            if parts_arg.endswith(".txt"):
+                with open(parts_arg) as f:
+                    parts = f.read().split()
+            else:
+                parts = [parts_arg]
+            self._costs.work(self._costs.merge * len(parts))
+            with open(current_build, "ab") as f_out:
+                for part in parts:
+                    with open(part, "rb") as f_in:
+                        shutil.copyfileobj(f_in, f_out)
+        elif macro == "chainSegments.C":
+            shutil.copy(args[1], args[0])
+        else:
+            raise NotImplementedError(macro)
+        return completed([macro] + list(args))
+
+    def _start_eventbuilding_pool(self):
+        return StubEventBuildingPool(self._costs, self._part_bytes)
+
+    def _start_part_decorations(self):
+        return StubPartDecorations(self._costs)
+
+    def _update_quality_info(self, finished=False):
+        self._record_lags("quality", self._build_parts())
+
+
+def create_run(run_dir, n_parts, part_bytes):
+    os.makedirs(run_dir)
+    with open(os.path.join(run_dir, my_paths.run_settings), "w") as f:
+        f.write("Synthetic run for benchmark_pipeline.py\n")
+    run_name = os.path.basename(run_dir)
+    for i_dat in range(n_parts):
+        write_part(os.path.join(run_dir, f"{run_name}.dat_{i_dat:04}"), part_bytes)
+    open(os.path.join(run_dir, "hitsHistogram.txt"), "w").close()
+
+
+def create_config(scenario_dir, n_workers, snapshot_every, overrides=()):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(repo_root, "monitoring.cfg"))
+    config["monitoring"]["output_parent"] = os.path.join(scenario_dir, "data")
+    config["monitoring"]["max_workers"] = str(n_workers)
+    config["monitoring"]["quality_info"] = "False"
+    config["monitoring"]["persistent_root"] = "False"
+    config["monitoring"]["eventbuilding_mode"] = "pool"
+    config["monitoring"]["live_metrics"] = "off"
+    config["snapshot"]["after"] = ""
+    config["snapshot"]["every"] = str(snapshot_every)
+    config["snapshot"]["incremental_decoration"] = "True"
+    calib_dir = os.path.join(scenario_dir, "calibration")
+    os.makedirs(calib_dir)
+    for calib in [
+        "pedestals_file",
+        "mip_calibration_file",
+        "pedestals_lg_file",
+        "mip_calibration_lg_file",
+        "mapping_file",
+        "mapping_file_cob",
+    ]:
+        calib_path = os.path.join(calib_dir, calib + ".txt")
+        open(calib_path, "w").close()
+        config["eventbuilding"][calib] = calib_path
+    for override in overrides:
+        key, value = override.split("=", 1)
+        section, key = key.split(".", 1)
+        config[section][key] = value
+    config_file = os.path.join(scenario_dir, "benchmark.cfg")
+    with open(config_file, "w") as f:
+        config.write(f)
+    return config_file
+
+
+def summarize(times, n_parts, n_workers):
+    timers = [t for per_worker in times.values() for t in per_worker]
+    loop_time = sum(t.time for t in timers if t.job_type == "LOOP")
+    job_types = [p.name for p in Priority if p is not Priority.IDLE]
+    jobs = [t for t in timers if t.job_type in job_types and t.worker >= 0]
+    busy_time = sum(t.time for t in jobs)
+    look_for_job_time = sum(t.time for t in timers if t.job_type == "LOOK_FOR_JOB")
+    return dict(
+        parts_per_s=n_parts / loop_time,
+        overhead_ms=1000 * look_for_job_time / max(1, len(jobs)),
+        idle_fraction=1 - busy_time / (loop_time * n_workers),
+        n_jobs=len(jobs),
+        loop_s=loop_time,
+    )
+
+
+def run_scenario(work_dir, n_parts, n_workers, costs, args):
+    name = f"{n_parts}parts_{n_workers}workers"
+    scenario_dir = os.path.join(work_dir, name)
+    run_dir = os.path.join(scenario_dir, "raw", f"benchmark_run_{n_parts:06}")
+    create_run(run_dir, n_parts, args.part_kb * 1024)
+    config_file = create_config(scenario_dir, n_workers, args.snapshot_every, args.set)
+    monitoring = BenchmarkMonitoring(run_dir, config_file, costs, args.part_kb * 1024)
+    try:
+        if args.verbose:
+            monitoring.start_loop()
+        else:
+            with contextlib.redirect_stdout(io.StringIO()):
+                monitoring.start_loop()
+    finally:
+        for handler in list(monitoring.logger.handlers):
+            monitoring.logger.removeHandler(handler)
+            handler.close()
+    return name, summarize(monitoring.times, n_parts, n_workers)
+
+
+def check_regressions(results, baseline, tolerance):
+    """Slower than the baseline by more than the (relative) tolerance."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result["parts_per_s"] < base["parts_per_s"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {result['parts_per_s']:.2f} parts/s "
+                f"< {base['parts_per_s']:.2f} parts/s"
+            )
+        # 1 ms of slack: At this level, it is mostly noise.
+        if result["overhead_ms"] > base["overhead_ms"] * (1 + tolerance) + 1:
+            regressions.append(
+                f"{name}: {result['overhead_ms']:.1f} ms overhead/job "
+                f"> {base['overhead_ms']:.1f} ms"
+            )
+        if result["idle_fraction"] > base["idle_fraction"] + tolerance:
+            regressions.append(
+                f"{name}: {result['idle_fraction']:.0%} idle "
+                f"> {base['idle_fraction']:.0%}"
+            )
+    return regressions
+
+
+def main(args):
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    costs = StubCosts(
+        args.convert_cost,
+        args.build_cost,
+        args.merge_cost,
+        args.decorate_cost,
+        args.cpu,
+    )
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="benchmark_pipeline_") as work_dir:
+        for n_parts in args.n_parts:
+            for n_workers in args.workers:
+                name, result = run_scenario(work_dir, n_parts, n_workers, costs, args)
+                results[name] = result
+                print(
+                    f"{name:<24}{result['parts_per_s']:>9.2f} parts/s"
+                    f"{result['overhead_ms']:>9.1f} ms overhead/job"
+                    f"{result['idle_fraction']:>7.0%} idle"
+                    f"{result['n_jobs']:>7} jobs{result['loop_s']:>8.1f}s"
+                )
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.save_baseline}.")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = check_regressions(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against " + args.baseline + ":")
+            print("\n".join("    " + r for r in regressions))
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the monitoring loop on synthetic runs, without ROOT.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--n_parts", nargs="+", type=int, default=[20, 100])
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 4, 10])
+    parser.add_argument("--part_kb", type=int, default=64, help="Size of each file.")
+    parser.add_argument("--convert_cost", type=float, default=0.05, help="Seconds.")
+    parser.add_argument("--build_cost", type=float, default=0.1, help="Seconds.")
+    parser.add_argument("--merge_cost", type=float, default=0.01, help="Per part.")
+    parser.add_argument("--decorate_cost", type=float, default=0.01, help="Per part.")
+    parser.add_argument(
+        "--cpu", action="store_true", help="Burn CPU in the stubs instead of sleeping."
+    )
+    parser.add_argument("--snapshot_every", type=int, default=10)
+    parser.add_argument(
+        "--set",
+        nargs="*",
+        default=[],
+        metavar="SECTION.KEY=VALUE",
+        help="Overwrite monitoring.cfg fields, e.g. monitoring.autoscale=True.",
+    )
+    parser.add_argument("--baseline", help="Fail on regressions against this json.")
+    parser.add_argument("--save_baseline", help="Store the results in this json.")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="Relative slack vs. baseline."
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    main(parser.parse_args())
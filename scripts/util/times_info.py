@@ -62,6 +62,10 @@ class TimingInfo:
             timer_field_names = [fs[0] for fs in self.timer_fields]
             assert fields == timer_field_names, f"{fields} != {timer_field_names}"
             timers = np.loadtxt(f, delimiter=",", dtype=self.timer_fields)
+        # Not job durations, but how long after its discovery a part was monitored.
+        is_lag = np.char.startswith(timers["job_type"], b"LAG_")
+        lags = timers[is_lag]
+        timers = timers[~is_lag]
         lines.append(
             "Jobs done in time window "
             f"{min(timers['timestamp']).decode('utf8')} - "
@@ -102,6 +106,15 @@ class TimingInfo:
                 )
             )
         lines.extend([line_string[1] for line_string in sorted(table_lines)[::-1]])
+        if len(lags):
+            lines.append("freshness lag       count       p50      p95      max")
+        for lag_type in np.unique(lags["job_type"]):
+            t = lags[lags["job_type"] == lag_type]["time"]
+            lines.append(
+                f"{lag_type.decode('utf8')[:20]:<20}{len(t):>5}  "
+                f"{np.percentile(t, 50):>8.2f}s{np.percentile(t, 95):>8.2f}s"
+                f"{t.max():>8.2f}s"
+            )
         return "\n".join(map(lambda x: 4 * " " + x, lines))[4:]
 
     def __str__(self):
@@ -3,13 +3,17 @@ import argparse
 import collections
 import concurrent.futures
 import configparser
+import contextlib
 import datetime
 import enum
+import fcntl
 import glob
+import heapq
 import importlib.util
 import logging
 import os
 import queue
+import re
 import shutil
 import subprocess
 import sys
@@ -38,9 +42,31 @@ def import_from(file_path):
     return module
 
 
+decorate = import_from(os.path.join(repo_root, "decorate.py"))
 quality_info = import_from(
     os.path.join(repo_root, "continuous_event_building", "quality_info.py")
 )
+raw_watcher = import_from(
+    os.path.join(repo_root, "continuous_event_building", "raw_watcher.py")
+)
+root_pool = import_from(
+    os.path.join(repo_root, "continuous_event_building", "root_pool.py")
+)
+eventbuilding_pool = import_from(
+    os.path.join(repo_root, "continuous_event_building", "eventbuilding_pool.py")
+)
+build_store = import_from(
+    os.path.join(repo_root, "continuous_event_building", "build_store.py")
+)
+live_metrics = import_from(
+    os.path.join(repo_root, "continuous_event_building", "live_metrics.py")
+)
+job_journal = import_from(
+    os.path.join(repo_root, "continuous_event_building", "job_journal.py")
+)
+tar_stream = import_from(
+    os.path.join(repo_root, "continuous_event_building", "tar_stream.py")
+)
 
 file_paths = dict(
     run_settings="Run_Settings.txt",
@@ -55,6 +81,9 @@ monitoring_subfolders = dict(
     converted_dir="converted",
     build_dir="build",
     snapshot_dir="snapshots",
+    compacted_dir="compacted",
+    quality_dir="quality_info",
+    decoration_dir="decoration_cache",
 )
 file_paths.update(**monitoring_subfolders)
 my_paths = collections.namedtuple("Paths", file_paths.keys())(**file_paths)
@@ -74,6 +103,21 @@ def without_tar(path):
     return path
 
 
+def reflink(src, dst):
+    """Copy-on-write clone of src (e.g. on btrfs or xfs): No data is copied.
+
+    Raises an OSError if the file system does not support it.
+    """
+    ficlone = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h.
+    try:
+        with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+            fcntl.ioctl(f_dst.fileno(), ficlone, f_src.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+
+
 def get_now_string():
     return datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
 
@@ -93,6 +137,129 @@ class Priority(enum.IntEnum):
     IDLE = 5
 
 
+class SchedulerQueue(queue.PriorityQueue):
+    """The job queue of the monitoring workers. Items are (Priority, -id, path).
+
+    Consumers take the `generation` before checking for work elsewhere (new raw
+    files, snapshot requests, ...). `get` then returns as soon as there is a job,
+    but raises `queue.Empty` right away if `wake_up` was called in the meantime.
+
+    A job is only queued once per (stage, path) key: Placeholder jobs like
+    (MERGE_EVENT_BUILDING, 0, "not used") are coalesced into the queued one.
+    With `stage_limits` ({Priority: n}), at most n jobs of that priority are handed
+    out until `finished` was called for them. Jobs of capped stages stay queued,
+    while jobs of other stages can be taken. With `aging` > 0, a job moves up one
+    priority level for every `aging` seconds it waited (no starvation).
+    """
+
+    def __init__(self, stage_limits=None, aging=0):
+        super().__init__()
+        self.generation = 0
+        self.stage_limits = dict(stage_limits or {})
+        self.aging = aging
+        self.running = collections.Counter()
+        self.depths = collections.Counter()
+        self._queued_since = {}
+
+    @staticmethod
+    def _key(item):
+        return item[0], item[2]
+
+    def put(self, item, block=True, timeout=None):
+        """Returns False (and queues nothing) if this job is already queued."""
+        with self.not_empty:
+            key = self._key(item)
+            if key in self._queued_since:
+                return False
+            self._queued_since[key] = time.monotonic()
+            self.depths[item[0]] += 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify_all()
+            return True
+
+    def wake_up(self):
+        with self.not_empty:
+            self.generation += 1
+            self.not_empty.notify_all()
+
+    def finished(self, priority):
+        with self.not_empty:
+            self.running[priority] -= 1
+            if priority in self.stage_limits:
+                self.not_empty.notify_all()
+
+    def n_available(self):
+        """The number of queued jobs that could be handed out right now."""
+        with self.not_empty:
+            n = 0
+            for priority, depth in self.depths.items():
+                limit = self.stage_limits.get(priority)
+                if limit is not None:
+                    depth = min(depth, max(0, limit - self.running[priority]))
+                n += depth
+            return n
+
+    def depth_by_stage(self):
+        with self.not_empty:
+            return {prio.name: n for prio, n in sorted(self.depths.items())}
+
+    def depth_string(self):
+        depths = self.depth_by_stage().items()
+        return " ".join(f"{stage}={n}" for stage, n in depths if n)
+
+    def wait(self, generation, timeout, for_jobs=True):
+        """Block until there is a job, `wake_up` was called or the timeout passed."""
+        with self.not_empty:
+            self._wait(generation, timeout, for_jobs)
+
+    def _effective_priority(self, item, now):
+        if self.aging <= 0:
+            return item
+        waited = now - self._queued_since[self._key(item)]
+        return (max(1, item[0] - int(waited / self.aging)),) + item
+
+    def _next_index(self):
+        if not self.stage_limits and self.aging <= 0:
+            return 0 if self._qsize() else None
+        now = time.monotonic()
+        for item in sorted(self.queue, key=lambda x: self._effective_priority(x, now)):
+            limit = self.stage_limits.get(item[0])
+            if limit is None or self.running[item[0]] < limit:
+                return self.queue.index(item)
+        return None
+
+    def _wait(self, generation, timeout, for_jobs=True):
+        end_time = None if timeout is None else time.monotonic() + timeout
+        while generation is None or generation == self.generation:
+            if for_jobs and self._next_index() is not None:
+                return
+            if end_time is None:
+                self.not_empty.wait()
+                continue
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                return
+            self.not_empty.wait(remaining)
+
+    def get(self, block=True, timeout=None, generation=None):
+        with self.not_empty:
+            if block:
+                self._wait(generation, timeout)
+            i_item = self._next_index()
+            if i_item is None:
+                raise queue.Empty
+            item = self.queue[i_item]
+            self.queue[i_item] = self.queue[-1]
+            self.queue.pop()
+            heapq.heapify(self.queue)
+            del self._queued_since[self._key(item)]
+            self.depths[item[0]] -= 1
+            self.running[item[0]] += 1
+            self.not_full.notify()
+            return item
+
+
 def priority_string(prios):
     chars = []
     for prio in prios:
@@ -188,7 +355,7 @@ def git_repo_status():
         repo_status += ["(at least one local-only commit)"]
 
     cmd = ["git", "diff-index", "--name-only", "HEAD"]
-    ret = subprocess.run(cmd, capture_output=True)
+    ret = subprocess.run(cmd, **kw)
     assert ret.stderr == b""
     changed_files = [f.decode() for f in filter(None, ret.stdout.split(b"\n"))]
     if len(changed_files) > 0:
@@ -369,9 +536,81 @@ class EcalMonitoring:
         configure_logging(self.logger, os.path.join(self.output_dir, my_paths.log_file))
         self.max_workers = int(get_with_fallback("monitoring", "max_workers", "10"))
         assert self.max_workers >= 1, self.max_workers
+        self._stage_limits = {}
+        for stage in [
+            Priority.CONVERSION,
+            Priority.EVENT_BUILDING,
+            Priority.MERGE_EVENT_BUILDING,
+            Priority.SNAP_SHOT,
+        ]:
+            limit = config["monitoring"].getint(f"max_{stage.name.lower()}", 0)
+            assert limit >= 0, f"max_{stage.name.lower()}={limit}"
+            if limit > 0:
+                self._stage_limits[stage] = limit
+        self._priority_aging = config["monitoring"].getfloat("priority_aging", 0)
+        self._live_metrics_mode = get_with_fallback("monitoring", "live_metrics", "off")
+        assert self._live_metrics_mode in ["off", "textfile", "http"], (
+            "live_metrics must be off, textfile or http, "
+            f"not {self._live_metrics_mode}."
+        )
+        self._live_metrics_port = config["monitoring"].getint("live_metrics_port", 9108)
+        self._live_metrics_interval = config["monitoring"].getfloat(
+            "live_metrics_interval", 5
+        )
+        self._autoscale = config["monitoring"].getboolean("autoscale", False)
+        self._autoscale_min_workers = config["monitoring"].getint(
+            "autoscale_min_workers", 2
+        )
+        self._autoscale_min_workers = min(self._autoscale_min_workers, self.max_workers)
+        assert self._autoscale_min_workers >= 1, self._autoscale_min_workers
+        self._autoscale_max_load = config["monitoring"].getfloat(
+            "autoscale_max_load", 1.0
+        )
+        self._autoscale_interval = config["monitoring"].getfloat(
+            "autoscale_interval", 10
+        )
         self._skip_dirty_dat = config["monitoring"].getboolean("skip_dirty_dat", False)
         self._binary_split_M = config["monitoring"].getint("binary_split_M", -1)
         self._quality_info = config["monitoring"].getboolean("quality_info", True)
+        self._quality_chunk_mb = config["monitoring"].getint(
+            "quality_info_chunk_mb", 100
+        )
+        self._quality_dpi = config["monitoring"].getint("quality_info_dpi", 300)
+        self._quality_format = get_with_fallback(
+            "monitoring", "quality_info_format", "png"
+        )
+        self._stream_compressed = config["monitoring"].getboolean(
+            "stream_compressed", False
+        )
+        self._build_store_mode = get_with_fallback(
+            "monitoring", "build_store", "merged"
+        )
+        assert self._build_store_mode in ["merged", "segmented"], (
+            "build_store must be merged or segmented: " + self._build_store_mode
+        )
+        self._compact_segments = config["monitoring"].getint("compact_segments", 0)
+        self._use_raw_file_watcher = config["monitoring"].getboolean(
+            "raw_file_watcher", True
+        )
+        self._persistent_root = config["monitoring"].getboolean(
+            "persistent_root", False
+        )
+        self._root_pool_size = int(
+            get_with_fallback("monitoring", "root_pool_size", str(self.max_workers))
+        )
+        assert self._root_pool_size >= 1, self._root_pool_size
+        self._eventbuilding_mode = get_with_fallback(
+            "monitoring", "eventbuilding_mode", "subprocess"
+        )
+        assert self._eventbuilding_mode in ["subprocess", "pool"], (
+            "eventbuilding_mode must be subprocess or pool: " + self._eventbuilding_mode
+        )
+        self._eventbuilding_workers = int(
+            get_with_fallback(
+                "monitoring", "eventbuilding_workers", str(self.max_workers)
+            )
+        )
+        assert self._eventbuilding_workers >= 1, self._eventbuilding_workers
 
         ev_building = config["eventbuilding"]
 
@@ -413,6 +652,21 @@ class EcalMonitoring:
         self._delete_previous_snaphots = config["snapshot"].getboolean(
             "delete_previous", False
         )
+        self._snapshot_data = get_with_fallback("snapshot", "data", "copy")
+        assert self._snapshot_data in ["copy", "reflink", "chain"], (
+            "[snapshot] data must be copy, reflink or chain: " + self._snapshot_data
+        )
+        self._separate_decoration = config["snapshot"].getboolean(
+            "separate_decoration", False
+        )
+        self._single_pass_decoration = config["snapshot"].getboolean(
+            "single_pass_decoration", False
+        )
+        self._decoration_threads = config["snapshot"].getint("decoration_threads", 0)
+        self._decoration_workers = config["snapshot"].getint("decoration_workers", 4)
+        self._incremental_decoration = config["snapshot"].getboolean(
+            "incremental_decoration", False
+        )
 
         with open(os.path.join(self.output_dir, my_paths.default_config), "w") as f:
             config.write(f)
@@ -422,9 +676,9 @@ class EcalMonitoring:
         tmp_run_settings = os.path.join(self.output_dir, my_paths.run_settings)
         run_settings = as_tar(os.path.join(self.raw_run_folder, my_paths.run_settings))
         if run_settings.endswith(".tar.gz"):
-            with tarfile.open(run_settings) as tar:
-                tar.extractall(path=self.output_dir)
-            assert os.path.exists(tmp_run_settings)
+            tar_stream.extract_member(
+                run_settings, my_paths.run_settings, tmp_run_settings
+            )
         else:
             shutil.copy(
                 os.path.join(self.raw_run_folder, my_paths.run_settings),
@@ -463,15 +717,49 @@ class EcalMonitoring:
         start_loop_time = time.time()
         self._largest_raw_dat = 0
         self._last_n_monitored = 0
-        self._new_merged = False
+        self._new_merged = threading.Event()
         self._snapshot_needs_current_build = False
+        self._current_build_released = threading.Condition()
+        self._startup_done = threading.Event()
         self._run_finished = False
         self._time_last_raw_check = 0
+        self._queued_raw_ids = set()
+        self._raw_check_lock = threading.Lock()
+        self._time_last_control_check = 0
+        self._control_check_lock = threading.Lock()
+        self._stop_requested = False
+        self._snapshot_requested = False
+        # Forks the event building workers, so it must come before any thread.
+        self._eventbuilding_pool = self._start_eventbuilding_pool()
+        if self._quality_info:
+            self._quality_renderer = quality_info.QualityRenderer(
+                self.logger, self._quality_rendered
+            )
+        else:
+            self._quality_renderer = None
+        queues = {}
+        queues["job"] = SchedulerQueue(self._stage_limits, self._priority_aging)
+        self._raw_watcher = self._start_raw_watcher(queues["job"])
+        self._control_watcher = self._start_control_watcher(queues["job"])
+        self._journal = self._open_journal()
+        self._build_store, self._compactor = self._start_build_store()
+        if self._persistent_root:
+            self._root_pool = root_pool.RootInterpreterPool(
+                self._root_pool_size, self.logger
+            )
+        else:
+            self._root_pool = None
+        self._part_decorations = self._start_part_decorations()
         self._time_last_snapshot = time.time()
         self._time_last_job = time.time()
         self._current_jobs = [Priority.IDLE for _ in range(self.max_workers)]
-        queues = {}
-        queues["job"] = queue.PriorityQueue()
+        if self._autoscale:
+            self._n_active_workers = self._autoscale_min_workers
+        else:
+            self._n_active_workers = self.max_workers
+        self._time_last_autoscale = time.time()
+        self._autoscale_lock = threading.Lock()
+        self._live_metrics = self._start_live_metrics(queues["job"])
         current_build = os.path.join(self.output_dir, my_paths.current_build)
         queues["current_build"] = queue.Queue(maxsize=1)
         queues["current_build"].put(current_build)
@@ -481,20 +769,19 @@ class EcalMonitoring:
             for i in range(self.max_workers):
                 job_args = [queues, i]
                 futures.append(executor.submit(self.find_and_do_job, *job_args))
-                time.sleep(1)  # Head start for the startup bookkeeping.
+                # Also wakes the quality info loop when the workers are done.
+                futures[-1].add_done_callback(lambda _: self._new_merged.set())
             if self._quality_info:
-                while not all(e.done() for e in futures):
-                    if self._new_merged:
-                        self._new_merged = False
-                        no_timeout = quality_info.get_quality_info(
-                            current_build_queue=queues["current_build"],
-                            monitoring=self,
-                            finished=False,
-                        )
-                        if not no_timeout:
-                            self._new_merged = True
-                    time.sleep(1)
+                while True:
+                    self._new_merged.wait()
+                    self._new_merged.clear()
+                    if all(e.done() for e in futures):
+                        break
+                    self._update_quality_info()
             self._debug_future_returns(futures, queues)
+        for watcher in [self._raw_watcher, self._control_watcher]:
+            if watcher is not None:
+                watcher.close()
         wrap_up_time = time.time()
         self.times[-1].append(
             Timer(
@@ -507,6 +794,16 @@ class EcalMonitoring:
             )
         )
         self._wrap_up(queues)
+        if self._quality_renderer is not None:
+            self._quality_renderer.close()  # The last render marks its parts.
+        self._log_freshness()
+        self._journal.close()
+        if self._live_metrics is not None:
+            self._live_metrics.close()
+        if self._root_pool is not None:
+            self._root_pool.close()
+        if self._eventbuilding_pool is not None:
+            self._eventbuilding_pool.close()
         self.logger.info(
             "🛬The run has finished. The monitoring has treated all files. "
         )
@@ -521,6 +818,60 @@ class EcalMonitoring:
             )
         )
 
+    def _start_build_store(self):
+        if self._build_store_mode != "segmented":
+            return None, None
+        store = build_store.BuildStore(self.output_dir)
+        n_unrecorded = store.reconcile(self._build_parts())
+        if n_unrecorded:
+            self.logger.warning(
+                f"📂{n_unrecorded} build parts were added to {store.manifest_path}."
+            )
+        if self._compact_segments > 1:
+            compactor = build_store.SegmentCompactor(
+                store,
+                self._merge_files,
+                os.path.join(self.output_dir, my_paths.compacted_dir),
+                os.path.join(self.output_dir, my_paths.tmp_dir),
+                self._compact_segments,
+            )
+            compactor.notify()
+        else:
+            compactor = None
+        return store, compactor
+
+    def _start_part_decorations(self):
+        if not self._incremental_decoration:
+            return None
+        return decorate.PartDecorations(
+            os.path.join(self.output_dir, my_paths.decoration_dir),
+            logger=self.logger,
+            root_pool=self._root_pool,
+            single_pass=self._single_pass_decoration,
+            n_threads=self._decoration_threads,
+            max_workers=self._decoration_workers,
+        )
+
+    def _start_eventbuilding_pool(self):
+        if self._eventbuilding_mode != "pool":
+            return None
+        builder_dir = os.path.join(my_paths.tb_analysis_dir, "eventbuilding")
+        try:
+            pool = eventbuilding_pool.EventBuildingPool(
+                builder_dir, self._eventbuilding_workers
+            )
+        except concurrent.futures.BrokenExecutor as e:
+            self.logger.error(
+                "⛔Aborted. The event building pool could not be started. "
+                "The python running the monitoring must also provide pyROOT "
+                f"for eventbuilding_mode = pool ({e})."
+            )
+            sys.exit(1)
+        self.logger.debug(
+            f"🔨Event building pool with {self._eventbuilding_workers} workers."
+        )
+        return pool
+
     def _debug_future_returns(self, futures, queues):
         """Check the futures for issues. Added for debugging; should be fast."""
         done, not_done = concurrent.futures.wait(
@@ -537,6 +888,8 @@ class EcalMonitoring:
                 "They are shut down now so that you can investigate the problem."
             )
             open(os.path.join(self.output_dir, "stop_monitoring"), "w").close()
+            self._stop_requested = True
+            queues["job"].wake_up()
             done, not_done = concurrent.futures.wait(
                 futures,
                 return_when=concurrent.futures.ALL_COMPLETED,
@@ -560,21 +913,24 @@ class EcalMonitoring:
         if not had_exception and not hasattr(self, "_stopped_gracefully"):
             queues["job"].join()
         assert queues["current_build"].qsize() == 1, queues["current_build"].queue
-        dir_converted = os.path.join(self.output_dir, my_paths.converted_dir)
-        dir_build = os.path.join(self.output_dir, my_paths.build_dir)
-        n_converted = len(os.listdir(dir_converted))
-        n_build = len(os.listdir(dir_build))
-        assert n_converted == n_build, f"{n_converted} != {n_build}"
+        not_built = self._journal.entries("converted")
+        assert len(not_built) == 0, f"Converted, but not in build/: {list(not_built)}"
 
     def find_and_do_job(self, queues, i_worker=0):
         self.times[i_worker] = []
         threading.current_thread().name = f"👷{i_worker:02}"
         job_queue = queues["job"]
         if i_worker == 0:
-            self._check_for_missing_builds(job_queue)
+            try:
+                self._check_for_missing_builds(job_queue)
+            finally:
+                self._startup_done.set()
+        else:
+            self._startup_done.wait()
         total_time_look_for_jobs = 0
         total_time_idle = 0
         while True:
+            generation = job_queue.generation
             time_look_for_jobs = time.time()
             self._look_for_snapshot_request(job_queue)
             # The try is not technically thread safe, but good enough here.
@@ -582,20 +938,24 @@ class EcalMonitoring:
                 assert job_queue.queue[0][0] < Priority.CONVERSION
             except (IndexError, AssertionError):
                 self._look_for_new_raw(job_queue)
+            self._autoscale_workers(job_queue, i_worker)
 
             all_done = self._run_finished and job_queue.empty()
-            file_stop_gracefully = os.path.join(self.output_dir, "stop_monitoring")
-            if all_done or os.path.exists(file_stop_gracefully):
+            if all_done or self._stop_requested:
                 if self._binary_split_M > 0 and all_done:
                     any_worker_might_split_large_binary = any(
                         [v == Priority.CONVERSION for v in self._current_jobs]
                     )
                     if any_worker_might_split_large_binary:
-                        time.sleep(1)
+                        # Woken up when that job is done.
+                        job_queue.wait(generation, self._idle_timeout())
                         continue
                 if not all_done:
                     if not hasattr(self, "_stopped_gracefully"):
                         self._stopped_gracefully = True
+                        file_stop_gracefully = os.path.join(
+                            self.output_dir, "stop_monitoring"
+                        )
                         self.logger.info(
                             "🤝Graceful stopping granted before end of monitoring. "
                             f"This was requested by {file_stop_gracefully}"
@@ -621,25 +981,37 @@ class EcalMonitoring:
                     )
                 )
                 return
+            if i_worker >= self._n_active_workers:
+                # Parked by the autoscaler, until the next wake up.
+                self._current_jobs[i_worker] = Priority.IDLE
+                job_queue.wait(generation, self._idle_timeout(), for_jobs=False)
+                continue
             try:
-                priority, neg_id_dat, in_file = job_queue.get(timeout=2)
+                priority, neg_id_dat, in_file = job_queue.get(
+                    timeout=self._idle_timeout(), generation=generation
+                )
             except queue.Empty:
                 self._current_jobs[i_worker] = Priority.IDLE
                 continue
+            n_bytes = self._job_input_bytes(priority, in_file)
             time_do_job = time.time()
             total_time_look_for_jobs += time_do_job - time_look_for_jobs
 
             self._current_jobs[i_worker] = priority
             print(priority_string(self._current_jobs), end="\r")
             if priority == Priority.CONVERSION:
-                res_file = self.convert_to_root(in_file, job_queue)
+                res_file = self.convert_to_root(in_file, job_queue, -neg_id_dat)
                 if res_file:
+                    self._journal.record("converted", res_file, -neg_id_dat)
                     job_queue.put((Priority.EVENT_BUILDING, neg_id_dat, res_file))
             elif priority == Priority.EVENT_BUILDING:
                 res_file = self.run_eventbuilding(in_file, -neg_id_dat)
                 if res_file:
-                    job_queue.put((Priority.MERGE_EVENT_BUILDING, 0, "not used"))
+                    self._journal.mark("built", [res_file])
+                    # The part first: The placeholder might be coalesced into a
+                    # queued one, which then has to find the part.
                     queues["merge"].put(res_file)
+                    job_queue.put((Priority.MERGE_EVENT_BUILDING, 0, "not used"))
             elif priority == Priority.MERGE_EVENT_BUILDING:
                 try:
                     self.merge_eventbuilding(queues)
@@ -661,6 +1033,10 @@ class EcalMonitoring:
             else:
                 raise NotImplementedError(priority)
             job_queue.task_done()
+            job_queue.finished(priority)
+            if job_queue.empty():
+                # Others might wait to check if everything is done.
+                job_queue.wake_up()
             self._time_last_job = time.time()
             if res_file:
                 self.times[i_worker].append(
@@ -673,18 +1049,28 @@ class EcalMonitoring:
                         data_path=self.output_dir,
                     )
                 )
+                if self._live_metrics is not None:
+                    self._live_metrics.job_done(
+                        priority.name, self._time_last_job - time_do_job, n_bytes
+                    )
             else:
                 total_time_idle += self._time_last_job - time_do_job
 
-    def _check_for_missing_builds(self, job_queue):
+    def _open_journal(self):
+        journal = job_journal.JobJournal(self.output_dir)
+        if journal.is_empty():
+            # Output dir from before the journal existed: Scan it once.
+            n_recorded = self._journal_from_directories(journal)
+            if n_recorded:
+                self.logger.warning(
+                    f"📒{n_recorded} existing parts were added to {journal.path}."
+                )
+        return journal
+
+    def _journal_from_directories(self, journal):
         conv_dir = os.path.join(self.output_dir, my_paths.converted_dir)
-        for conv_part in os.listdir(conv_dir):
-            name = conv_part.replace("converted_", "build")
-            if os.path.exists(os.path.join(self.output_dir, my_paths.tmp_dir, name)):
-                continue
-            if os.path.exists(os.path.join(self.output_dir, my_paths.build_dir, name)):
-                continue
-            conv_path = os.path.join(conv_dir, conv_part)
+        build_dir = os.path.join(self.output_dir, my_paths.build_dir)
+        for conv_part in sorted(os.listdir(conv_dir)):
             if "_monitoring_split_" in conv_part:
                 normal_part, split_part = conv_part.split("_monitoring_split_")
                 split_id = int(split_part[: -len(".root")])
@@ -695,16 +1081,172 @@ class EcalMonitoring:
                 id_job = 10000 * normal_id + split_id
             else:
                 id_job = int(conv_part[: -len(".root")][-4:])
-            job_queue.put((Priority.EVENT_BUILDING, -id_job, conv_path))
+            journal.record("converted", os.path.join(conv_dir, conv_part), id_job)
+        build_parts = sorted(os.listdir(build_dir))
+        for build_part in build_parts:
+            journal.record("merged", os.path.join(build_dir, build_part))
+        return len(journal.entries())
+
+    def _check_for_missing_builds(self, job_queue):
+        """Replay the journal: Build the converted parts, do not convert them again."""
+        for entry in self._journal.entries().values():
+            if entry.id is not None:
+                self._queued_raw_ids.add(entry.id)
+        for entry in self._journal.entries("converted").values():
+            job_queue.put((Priority.EVENT_BUILDING, -entry.id, entry.path))
         return True
 
+    def _start_live_metrics(self, job_queue):
+        if self._live_metrics_mode == "off":
+            return None
+
+        def sample():
+            workers = collections.Counter(busy=0, idle=0)
+            for i, prio in enumerate(self._current_jobs):
+                if i >= self._n_active_workers:
+                    workers["parked"] += 1
+                elif prio == Priority.IDLE:
+                    workers["idle"] += 1
+                else:
+                    workers["busy"] += 1
+            return dict(queue_depth=job_queue.depth_by_stage(), workers=workers)
+
+        try:
+            metrics = live_metrics.LiveMetrics(
+                sample,
+                self._live_metrics_mode,
+                self.output_dir,
+                self._live_metrics_port,
+                self._live_metrics_interval,
+                logger=self.logger,
+            )
+        except OSError as e:
+            self.logger.warning(f"📊No live metrics ({e}).")
+            return None
+        if metrics.textfile_path is not None:
+            self.logger.info(f"📊Live metrics are written to {metrics.textfile_path}")
+        else:
+            self.logger.info(
+                "📊Live metrics at "
+                f"http://127.0.0.1:{self._live_metrics_port}/metrics"
+            )
+        return metrics
+
+    def _job_input_bytes(self, priority, in_file):
+        """For the throughput in the live metrics."""
+        if self._live_metrics is None:
+            return 0
+        if priority not in [Priority.CONVERSION, Priority.EVENT_BUILDING]:
+            return 0
+        try:
+            return os.path.getsize(as_tar(in_file))
+        except OSError:
+            return 0
+
+    def _autoscale_workers(self, job_queue, i_worker):
+        """Grow or shrink the number of active workers from the load and queue."""
+        if not self._autoscale:
+            return
+        if time.time() - self._time_last_autoscale < self._autoscale_interval:
+            return
+        if not self._autoscale_lock.acquire(blocking=False):
+            return
+        try:
+            self._time_last_autoscale = time.time()
+            load = os.getloadavg()[0] / os.cpu_count()
+            n_queued = job_queue.n_available()  # Capped stages might have to wait.
+            n_active = self._n_active_workers
+            if load > self._autoscale_max_load:
+                if n_active <= self._autoscale_min_workers:
+                    return
+                n_active -= 1
+                decision = "AUTOSCALE_DOWN"
+            elif n_queued > n_active:
+                if n_active >= self.max_workers:
+                    return
+                n_active += 1
+                decision = "AUTOSCALE_UP"
+            else:
+                return
+            self._n_active_workers = n_active
+            job_queue.wake_up()
+            self.logger.info(
+                f"{'📈' if decision == 'AUTOSCALE_UP' else '📉'}"
+                f"{n_active}/{self.max_workers} active workers "
+                f"(load per core {load:.2f}, queued: {job_queue.depth_string()})."
+            )
+            self.times[i_worker].append(
+                Timer(
+                    job_type=decision,
+                    time=0,
+                    timestamp=get_now_string(),
+                    id=n_active,
+                    worker=i_worker,
+                    data_path=self.output_dir,
+                )
+            )
+        finally:
+            self._autoscale_lock.release()
+
+    def _start_raw_watcher(self, job_queue):
+        if not self._use_raw_file_watcher:
+            return None
+        try:
+            watcher = raw_watcher.RawFileWatcher(
+                self.raw_run_folder,
+                on_new_file=lambda _: job_queue.wake_up(),
+                logger=self.logger,
+            )
+        except OSError as e:
+            self.logger.warning(
+                f"👀No event-driven raw file discovery ({e}). "
+                "Falling back to scanning the raw run folder."
+            )
+            return None
+        self.logger.debug(f"👀Watching {self.raw_run_folder} for new raw files.")
+        return watcher
+
+    def _start_control_watcher(self, job_queue):
+        """Wake up the workers as soon as a control file is created."""
+        if not self._use_raw_file_watcher:
+            return None
+        try:
+            return raw_watcher.RawFileWatcher(
+                self.output_dir,
+                on_new_file=lambda _: job_queue.wake_up(),
+                names=["get_snapshot", "stop_monitoring"],
+                logger=self.logger,
+            )
+        except OSError:
+            return None
+
+    def _idle_timeout(self):
+        """How long a worker waits without being woken up."""
+        watchers = [self._raw_watcher, self._control_watcher]
+        if any(w is None or not w.is_alive() for w in watchers):
+            return 2  # The folders are scanned, as before.
+        # Events wake the workers. The scan only serves as safety net.
+        return 30
+
     def _look_for_new_raw(self, job_queue):
         if self._run_finished:
             return
-        delta_t_daq_output_checks = 2  # in seconds.
+        if not self._raw_check_lock.acquire(blocking=False):
+            return  # Another worker is already looking.
+        try:
+            self._look_for_new_raw_locked(job_queue)
+        finally:
+            self._raw_check_lock.release()
+
+    def _look_for_new_raw_locked(self, job_queue):
+        if self._raw_watcher is None or not self._raw_watcher.is_alive():
+            delta_t_daq_output_checks = 2  # in seconds.
+        else:
+            # The scan only serves as safety net, e.g. for network file systems.
+            delta_t_daq_output_checks = 30
+            if self._queue_watched_raw(job_queue):
+                self._time_last_raw_check = 0
         if time.time() - self._time_last_raw_check < delta_t_daq_output_checks:
-            if job_queue.empty():
-                time.sleep(delta_t_daq_output_checks)
             return
         self._time_last_raw_check = time.time()
         dat_pattern = os.path.join(self.raw_run_folder, "*.dat_[0-9][0-9][0-9][0-9]")
@@ -718,7 +1260,7 @@ class EcalMonitoring:
             for i in range(self._largest_raw_dat, new_largest_dat):
                 path = path_start + f"{i:04}"
                 if os.path.exists(as_tar(path)):
-                    job_queue.put((Priority.CONVERSION, -i, path))
+                    self._queue_conversion(job_queue, i, path)
             self._largest_raw_dat = new_largest_dat
             self._special_case_0000(job_queue, ".dat")
         file_run_finished = as_tar(
@@ -728,7 +1270,7 @@ class EcalMonitoring:
         self._check_for_binary(dat_files, job_queue)
         if self._run_finished:
             if len(dat_files) > 0:
-                job_queue.put((Priority.CONVERSION, -new_largest_dat, dat_files[-1]))
+                self._queue_conversion(job_queue, new_largest_dat, dat_files[-1])
             else:
                 self._special_case_0000(job_queue, ".dat")
                 self._special_case_0000(job_queue, "_raw.bin")
@@ -756,10 +1298,35 @@ class EcalMonitoring:
             for i in range(self._largest_raw_dat, new_largest_dat):
                 path = path_start + f"{i:04}"
                 if os.path.exists(as_tar(path)):
-                    job_queue.put((Priority.CONVERSION, -i, path))
+                    self._queue_conversion(job_queue, i, path)
             self._largest_raw_dat = new_largest_dat
             self._special_case_0000(job_queue, bin_ext)
 
+    _numbered_raw_part = re.compile(r"(\.dat|_raw\.bin.*)_(?P<id>[0-9]{4})$")
+
+    def _queue_watched_raw(self, job_queue):
+        """Queue the parts that the DAQ closed. True if a folder scan is needed."""
+        needs_scan = False
+        for path in map(without_tar, self._raw_watcher.pop_new_files()):
+            name = os.path.basename(path)
+            match = self._numbered_raw_part.search(name)
+            if match:
+                self._queue_conversion(job_queue, int(match.group("id")), path)
+            elif name == "hitsHistogram.txt":
+                needs_scan = True
+            elif name.endswith(".dat") or name.endswith("_raw.bin"):
+                # The first part has no number. Leave it to _special_case_0000.
+                needs_scan = True
+        return needs_scan
+
+    def _queue_conversion(self, job_queue, id_dat, path):
+        if id_dat in self._queued_raw_ids:
+            return False
+        self._queued_raw_ids.add(id_dat)
+        job_queue.put((Priority.CONVERSION, -id_dat, path))
+        self._journal.mark("discovered", [path])
+        return True
+
     def _special_case_0000(self, job_queue, pattern=".dat"):
         if hasattr(self, "_already_done_0000"):
             return False
@@ -782,22 +1349,42 @@ class EcalMonitoring:
                 return False
             elif os.path.exists(as_tar(raw_file_path)):
                 self._already_done_0000 = True
-                job_queue.put((Priority.CONVERSION, 0, raw_file_path))
+                self._queue_conversion(job_queue, 0, raw_file_path)
                 return True
         else:
             raise NotImplementedError(first_dat_glob)
         return False
 
+    def _check_control_files(self):
+        """Look for stop_monitoring and get_snapshot, at a bounded rate.
+
+        With the control watcher, the files are only checked when it saw one of
+        them being created, or as safety net every 30 seconds.
+        """
+        if self._control_watcher is None or not self._control_watcher.is_alive():
+            delta_t_control_checks = 1  # in seconds.
+        else:
+            delta_t_control_checks = 30
+        with self._control_check_lock:
+            news = self._control_watcher and self._control_watcher.pop_new_files()
+            since_last_check = time.time() - self._time_last_control_check
+            if not news and since_last_check < delta_t_control_checks:
+                return
+            self._time_last_control_check = time.time()
+            if os.path.exists(os.path.join(self.output_dir, "stop_monitoring")):
+                self._stop_requested = True
+            file_get_snapshot = os.path.join(self.output_dir, "get_snapshot")
+            if os.path.exists(file_get_snapshot):
+                os.remove(file_get_snapshot)
+                self._snapshot_requested = True
+
     def _look_for_snapshot_request(self, job_queue, check_scheduled=False):
-        schedule_snapshot = False
-        file_get_snapshot = os.path.join(self.output_dir, "get_snapshot")
-        if os.path.exists(file_get_snapshot):
-            os.remove(file_get_snapshot)
-            schedule_snapshot = True
+        self._check_control_files()
+        with self._control_check_lock:
+            schedule_snapshot = self._snapshot_requested
+            self._snapshot_requested = False
         if check_scheduled:
-            n_build_parts = len(
-                os.listdir(os.path.join(self.output_dir, my_paths.build_dir))
-            )
+            n_build_parts = self._journal.n_parts("merged")
             for ss_after in self._snapshot_after:
                 if self._last_n_monitored < ss_after <= n_build_parts:
                     schedule_snapshot = True
@@ -831,7 +1418,7 @@ class EcalMonitoring:
             f"To suppress this info, create the file {file_suppress_idle_info} "
         )
 
-    def convert_to_root(self, raw_file_path, job_queue):
+    def convert_to_root(self, raw_file_path, job_queue, id_dat=-1):
         raw_file_name = os.path.basename(raw_file_path)
         raw_file_path = as_tar(raw_file_path)
         if self._skip_dirty_dat:
@@ -847,36 +1434,36 @@ class EcalMonitoring:
             return out_path
         tmp_dir = os.path.join(self.output_dir, my_paths.tmp_dir)
         tmp_path = os.path.join(tmp_dir, converted_name)
+        stream = None
         if raw_file_path.endswith(".tar.gz"):
-            with tarfile.open(raw_file_path) as tar:
-                tar.extractall(path=tmp_dir)
             in_path = os.path.join(tmp_dir, raw_file_name)
-            assert os.path.exists(in_path), in_path
+            if self._can_stream(raw_file_path, raw_file_name):
+                stream = tar_stream.TarMemberFifo(raw_file_path, raw_file_name, in_path)
+            else:
+                with tarfile.open(raw_file_path) as tar:
+                    tar.extractall(path=tmp_dir)
+                assert os.path.exists(in_path), in_path
         else:
             in_path = raw_file_path
 
         root_macro_dir = os.path.join(my_paths.tb_analysis_dir, "converter_SLB")
         if "_raw.bin" in raw_file_name:
-            root_call = (
-                f'"RawConvertDataSL.cc(\\"{in_path}\\", false, \\"{tmp_path}\\")"'
-            )
-            if self._split_binary_too_large(in_path, job_queue):
+            macro = "RawConvertDataSL.cc"
+            if stream is None and self._split_binary_too_large(in_path, job_queue):
                 return False
         elif ".dat" in raw_file_name:
-            root_call = f'"ConvertDataSL.cc(\\"{in_path}\\", false, \\"{tmp_path}\\")"'
+            macro = "ConvertDataSL.cc"
         else:
             raise NotImplementedError(raw_file_name)
-        ret = subprocess.run(
-            "root -b -l -q " + root_call,
-            shell=True,
-            capture_output=True,
-            cwd=root_macro_dir,
-        )
+        with stream if stream is not None else contextlib.nullcontext():
+            ret = self._run_root_macro(root_macro_dir, macro, in_path, False, tmp_path)
         if ret.returncode != 0 or ret.stderr != b"":
             log_unexpected_error_subprocess(self.logger, ret, " during convert_to_root")
             sys.exit(1)
         os.rename(tmp_path, out_path)
-        if raw_file_path.endswith(".tar.gz"):
+        if stream is not None:
+            self._log_decompression(stream, id_dat)
+        elif raw_file_path.endswith(".tar.gz"):
             os.remove(in_path)
         elif "_monitoring_split_" in os.path.basename(in_path):
             os.remove(in_path)
@@ -885,6 +1472,47 @@ class EcalMonitoring:
         )
         return out_path
 
+    def _can_stream(self, tar_path, raw_file_name):
+        """Binary parts that must be split need a real file for `split`."""
+        if not self._stream_compressed:
+            return False
+        if "_raw.bin" in raw_file_name and self._binary_split_M > 0:
+            size = tar_stream.member_size(tar_path, raw_file_name)
+            return size <= 1024**2 * self._binary_split_M
+        return True
+
+    def _log_decompression(self, stream, id_dat):
+        self.times[-1].append(
+            Timer(
+                job_type="DECOMPRESS",
+                time=stream.time,
+                timestamp=get_now_string(),
+                id=id_dat,
+                worker=-1,
+                data_path=self.output_dir,
+            )
+        )
+        self.logger.debug(
+            f"📦Streamed {stream.n_bytes / 1024**2:.1f} MB from "
+            f"{os.path.basename(stream.tar_path)} "
+            f"({stream.throughput / 1024**2:.1f} MB/s)."
+        )
+
+    def _run_root_macro(self, macro_dir, macro, *args):
+        """Execute `macro(*args)`, in a pooled interpreter if configured."""
+        if self._root_pool is not None:
+            return self._root_pool.run(
+                os.path.join(macro_dir, macro), *args, data_path=self.output_dir
+            )
+        call = f"{macro}({', '.join(map(root_pool.as_cpp_literal, args))})"
+        root_call = '"' + call.replace('"', '\\"') + '"'
+        return subprocess.run(
+            "root -b -l -q " + root_call,
+            shell=True,
+            capture_output=True,
+            cwd=macro_dir,
+        )
+
     def _split_binary_too_large(self, binary_path, job_queue):
         try:
             binary_id = int(binary_path[-4:]) + 1
@@ -912,10 +1540,12 @@ class EcalMonitoring:
                     self.logger, ret, " during _split_binary_too_large"
                 )
                 sys.exit(1)
+            t_discovered = self._journal.first_time(binary_path, "discovered")
             for i, binary_part in enumerate(sorted(glob.glob(part_prefix + "*"))):
                 binary_part_path = os.path.join(tmp_dir, binary_part)
                 id_job = 10000 * binary_id + i
                 job_queue.put((Priority.CONVERSION, -id_job, binary_part_path))
+                self._journal.mark("discovered", [binary_part_path], t_discovered)
             return True
         return False
 
@@ -933,18 +1563,22 @@ class EcalMonitoring:
         in_path = os.path.join(self.output_dir, my_paths.converted_dir, converted_name)
 
         builder_dir = os.path.join(my_paths.tb_analysis_dir, "eventbuilding")
-        args = f" --converted_path {in_path} --build_path {tmp_path}"
-        self.eventbuilding_args["id_dat"] = int(id_dat)
+        cli_args = ["--converted_path", in_path, "--build_path", tmp_path]
+        eventbuilding_args = dict(self.eventbuilding_args)
+        eventbuilding_args["id_dat"] = int(id_dat)
         # With `capture_output=True`, printing the progress info makes no sense.
-        self.eventbuilding_args["no_progress_info"] = "True"
-        for k, v in self.eventbuilding_args.items():
-            args += f" --{k} {v}"
-        ret = subprocess.run(
-            "./build_events.py" + args,
-            shell=True,
-            capture_output=True,
-            cwd=builder_dir,
-        )
+        eventbuilding_args["no_progress_info"] = "True"
+        for k, v in eventbuilding_args.items():
+            cli_args.extend([f"--{k}", str(v)])
+        if self._eventbuilding_pool is None:
+            ret = subprocess.run(
+                "./build_events.py " + " ".join(cli_args),
+                shell=True,
+                capture_output=True,
+                cwd=builder_dir,
+            )
+        else:
+            ret = self._eventbuilding_pool.build(cli_args)
         if ret.returncode != 0 or ret.stderr != b"":
             log_unexpected_error_subprocess(
                 self.logger, ret, " during run_eventbuilding"
@@ -953,48 +1587,200 @@ class EcalMonitoring:
         return tmp_path
 
     def merge_eventbuilding(self, queues):
-        while self._snapshot_needs_current_build:
-            time.sleep(1)
+        if self._build_store is not None:
+            return self._append_segments(queues)
+        with self._current_build_released:
+            self._current_build_released.wait_for(
+                lambda: not self._snapshot_needs_current_build
+            )
         current_build = queues["current_build"].get(timeout=2)
         files_to_merge = []
         while queues["merge"].qsize():
             files_to_merge.append(queues["merge"].get(timeout=0.1))
-        for tmp_path in files_to_merge:
-            self._single_merge_eventbuilding(tmp_path, current_build)
+        self._batch_merge_eventbuilding(files_to_merge, current_build)
+        for _ in files_to_merge:
             queues["merge"].task_done()
         queues["current_build"].put(current_build)
         queues["current_build"].task_done()
-        self._new_merged = True
+        self._new_merged.set()
 
-    def _single_merge_eventbuilding(self, tmp_path, current_build):
-        build_name = os.path.basename(tmp_path)
-        part_path = os.path.join(self.output_dir, my_paths.build_dir, build_name)
-        if os.path.exists(part_path):
-            return part_path
+    def _append_segments(self, queues):
+        """Segmented build store: The build part itself becomes a segment."""
+        while queues["merge"].qsize():
+            tmp_path = queues["merge"].get(timeout=0.1)
+            build_name = os.path.basename(tmp_path)
+            part_path = os.path.join(self.output_dir, my_paths.build_dir, build_name)
+            if self._journal.stage(part_path) != "merged":
+                os.rename(tmp_path, part_path)
+                self._build_store.append(part_path)
+                self._journal.record("merged", part_path)
+                self.logger.debug(f"🔨New event file {build_name} at {part_path}")
+            queues["merge"].task_done()
+        if self._compactor is not None:
+            self._compactor.notify()
+        self._new_merged.set()
+
+    def _batch_merge_eventbuilding(self, tmp_paths, current_build):
+        build_dir = os.path.join(self.output_dir, my_paths.build_dir)
+        new_parts = []
+        for tmp_path in tmp_paths:
+            part_path = os.path.join(build_dir, os.path.basename(tmp_path))
+            if self._journal.stage(part_path) != "merged":
+                new_parts.append(tmp_path)
+        self._merge_into(current_build, new_parts)
+        # Only now the parts are moved (each atomically) into build/:
+        # This way, the journal can still be trusted after a crash.
+        for tmp_path in new_parts:
+            part_path = os.path.join(build_dir, os.path.basename(tmp_path))
+            os.rename(tmp_path, part_path)
+            self._journal.record("merged", part_path)
+            self.logger.debug(
+                f"🔨New event file " f"{os.path.basename(part_path)} at {part_path}"
+            )
+
+    def _merge_into(self, current_build, new_parts):
+        """Add the ecal trees of all new_parts with a single mergeSelective call."""
+        if len(new_parts) == 0:
+            return
         if not os.path.exists(current_build):
             # The first build.root part that was finished.
-            shutil.copy(tmp_path, current_build)
+            shutil.copy(new_parts[0], current_build)
+            new_parts = new_parts[1:]
+            if len(new_parts) == 0:
+                return
+        if len(new_parts) == 1:
+            parts_arg = new_parts[0]
         else:
-            root_macro_dir = os.path.join(
-                os.path.dirname(os.path.abspath(__file__)), "continuous_event_building"
+            parts_arg = os.path.join(
+                self.output_dir,
+                my_paths.tmp_dir,
+                os.path.basename(current_build) + ".merge_list.txt",
             )
-            args = '\\"' + '\\", \\"'.join((current_build, tmp_path, "ecal")) + '\\"'
-            root_call = f'"mergeSelective.C({args})"'
-            ret = subprocess.run(
-                "root -b -l -q " + root_call,
-                shell=True,
-                capture_output=True,
-                cwd=root_macro_dir,
+            with open(parts_arg, "w") as f:
+                f.write("".join(p + "\n" for p in new_parts))
+        root_macro_dir = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "continuous_event_building"
+        )
+        ret = self._run_root_macro(
+            root_macro_dir, "mergeSelective.C", current_build, parts_arg, "ecal"
+        )
+        if len(new_parts) > 1:
+            os.remove(parts_arg)
+        if ret.returncode != 0 or ret.stderr != b"":
+            log_unexpected_error_subprocess(
+                self.logger, ret, " during merge_eventbuilding"
             )
-            if ret.returncode != 0 or ret.stderr != b"":
-                log_unexpected_error_subprocess(
-                    self.logger, ret, " during merge_eventbuilding"
+            sys.exit(1)
+        if len(new_parts) > 1:
+            self.logger.debug(f"🔗{len(new_parts)} parts merged in a single pass.")
+
+    def _merge_files(self, out_path, in_paths):
+        """Merge the ecal trees of the inputs into a new file."""
+        assert not os.path.exists(out_path), out_path
+        self._merge_into(out_path, list(in_paths))
+
+    def _write_chain(self, out_path, segments):
+        """A small file with a TChain over all segments (e.g. the build parts)."""
+        segment_list = out_path + ".segments.txt"
+        with open(segment_list, "w") as f:
+            f.write("".join(p + "\n" for p in segments))
+        root_macro_dir = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "continuous_event_building"
+        )
+        ret = self._run_root_macro(
+            root_macro_dir, "chainSegments.C", out_path, segment_list, "ecal"
+        )
+        os.remove(segment_list)
+        if ret.returncode != 0 or ret.stderr != b"":
+            log_unexpected_error_subprocess(self.logger, ret, " during _write_chain")
+            sys.exit(1)
+
+    def _build_parts(self):
+        """The immutable parts in build/. All of them are in the merged build."""
+        return self._journal.paths("merged")
+
+    def _copy_build(self, build_file, out_path):
+        if self._snapshot_data == "reflink":
+            try:
+                return reflink(build_file, out_path)
+            except OSError as e:
+                self.logger.warning(
+                    f"🔎No reflink snapshots on this file system ({e}). "
+                    "Falling back to copying the build file."
                 )
-                sys.exit(1)
-        os.rename(tmp_path, part_path)
-        self.logger.debug(
-            f"🔨New event file " f"{os.path.basename(part_path)} at {part_path}"
+                self._snapshot_data = "copy"
+        shutil.copy(build_file, out_path)
+
+    def _update_quality_info(self, finished=False):
+        """Only parts that are new since the last call are read."""
+        build_parts = self._build_parts()
+        quality_info.get_quality_info(
+            monitoring=self,
+            build_parts=build_parts,
+            aggregates_dir=os.path.join(self.output_dir, my_paths.quality_dir),
+            finished=finished,
+            renderer=self._quality_renderer,
+        )
+        if self._quality_renderer is None:  # Drawn right away.
+            self._record_lags("quality", build_parts)
+
+    def _record_lags(self, milestone, build_parts):
+        """How long after their discovery the parts first reached `milestone`."""
+        lags = self._journal.mark(milestone, build_parts)
+        for lag in lags:
+            self.times[-1].append(
+                Timer(
+                    job_type=f"LAG_{milestone.upper()}",
+                    time=lag,
+                    timestamp=get_now_string(),
+                    id=-1,
+                    worker=-1,
+                    data_path=self.output_dir,
+                )
+            )
+        if lags:
+            summary = job_journal.lag_summary(lags)
+            self.logger.debug(
+                f"⏱Freshness lag of the parts new in the {milestone}: {summary}"
+            )
+
+    def _log_freshness(self):
+        for milestone in ["snapshot", "quality"]:
+            lags = self._journal.lags(milestone)
+            if lags:
+                summary = job_journal.lag_summary(lags)
+                self.logger.info(
+                    f"⏱Freshness lag from discovery to {milestone}: {summary}"
+                )
+
+    def _quality_rendered(self, img_path, duration, build_parts):
+        self._record_lags("quality", build_parts)
+        self.times[-1].append(
+            Timer(
+                job_type="QUALITY_RENDER",
+                time=duration,
+                timestamp=get_now_string(),
+                id=-1,
+                worker=-1,
+                data_path=img_path,
+            )
+        )
+
+    def _consolidate_segments(self, current_build):
+        """Segmented build store: Create the single-file build at the end."""
+        if self._compactor is not None:
+            self._compactor.close()
+        segments = self._build_store.segment_paths()
+        if len(segments) == 0:
+            return
+        tmp_path = os.path.join(
+            self.output_dir, my_paths.tmp_dir, os.path.basename(current_build)
         )
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        self._merge_files(tmp_path, segments)
+        os.replace(tmp_path, current_build)
+        self.logger.debug(f"📂{len(segments)} segments merged into {current_build}.")
 
     def get_snapshot(
         self,
@@ -1016,44 +1802,88 @@ class EcalMonitoring:
         tmp_snap_path = os.path.join(
             self.output_dir, my_paths.tmp_dir, os.path.basename(snap_path)
         )
-        n_build_parts = len(
-            os.listdir(os.path.join(self.output_dir, my_paths.build_dir))
-        )
+        n_build_parts = self._journal.n_parts("merged")
         if self._last_n_monitored < n_build_parts:
             self._last_n_monitored = n_build_parts
         elif not force_snapshot:
             return False
-        if build_file is None:
+        # The build parts that are decorated: Never more than the snapshot data.
+        if build_file is None and self._build_store is not None:
+            build_parts = self._build_parts()  # Listed before the data.
+            self._write_chain(tmp_snap_path, self._build_store.segment_paths())
+        elif build_file is None and self._snapshot_data == "chain":
+            # No need for the current_build token: The build parts are immutable.
+            build_parts = self._build_parts()
+            self._write_chain(tmp_snap_path, build_parts)
+        elif build_file is None:
             self._snapshot_needs_current_build = True
             build_file = current_build_queue.get()
-            shutil.copy(
-                build_file,
-                tmp_snap_path,
-            )
-            self._snapshot_needs_current_build = False
+            # Nothing is merged into the build file while it is held.
+            build_parts = self._build_parts()
+            self._copy_build(build_file, tmp_snap_path)
             current_build_queue.put(build_file)
             current_build_queue.task_done()
+            with self._current_build_released:
+                self._snapshot_needs_current_build = False
+                self._current_build_released.notify_all()
         else:
-            shutil.copy(
-                build_file,
-                tmp_snap_path,
+            build_parts = self._build_parts()  # The caller holds the build file.
+            self._copy_build(build_file, tmp_snap_path)
+        if self._separate_decoration:
+            tmp_deco_path = decorate.add_suffix_before_extension(
+                tmp_snap_path, "_decoration"
             )
+        else:
+            tmp_deco_path = tmp_snap_path
         deco_times_file = "times_decorate.py.csv"
         deco_times_file = os.path.join(self.output_dir, ".times", deco_times_file)
-        ret = subprocess.run(
-            f"./decorate.py {tmp_snap_path} --times_file {deco_times_file}",
-            shell=True,
-            capture_output=True,
-            cwd=os.path.dirname(os.path.abspath(__file__)),
-        )
-        if ret.returncode != 0 or ret.stderr != b"":
-            log_unexpected_error_subprocess(self.logger, ret, " during get_snapshot")
-            sys.exit(1)
+        if self._part_decorations is not None:
+            self._part_decorations.update(build_parts)
+            self._part_decorations.add_to(tmp_deco_path)
+        elif self._root_pool is None:
+            deco_call = f"./decorate.py {tmp_snap_path} --times_file {deco_times_file}"
+            deco_call += f" --output_file {tmp_deco_path}"
+            deco_call += f" --threads {self._decoration_threads}"
+            deco_call += f" --workers {self._decoration_workers}"
+            if self._single_pass_decoration:
+                deco_call += " --single_pass"
+            ret = subprocess.run(
+                deco_call,
+                shell=True,
+                capture_output=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+            )
+            if ret.returncode != 0 or ret.stderr != b"":
+                log_unexpected_error_subprocess(
+                    self.logger, ret, " during get_snapshot"
+                )
+                sys.exit(1)
+        else:
+            # In-process, so that the plugins can use the pooled interpreters.
+            mps = decorate.MonitoringPlugins(
+                tmp_snap_path,
+                logger=self.logger,
+                root_pool=self._root_pool,
+                output_file=tmp_deco_path,
+                single_pass=self._single_pass_decoration,
+                n_threads=self._decoration_threads,
+                max_workers=self._decoration_workers,
+            )
+            mps.shoot()
+            if not os.path.isdir(os.path.dirname(deco_times_file)):
+                os.mkdir(os.path.dirname(deco_times_file))
+            mps.write_times(deco_times_file)
         os.rename(tmp_snap_path, snap_path)
+        if tmp_deco_path != tmp_snap_path and os.path.exists(tmp_deco_path):
+            deco_name = os.path.basename(tmp_deco_path)
+            os.rename(
+                tmp_deco_path, os.path.join(os.path.dirname(snap_path), deco_name)
+            )
         if self._delete_previous_snaphots:
             snap_dir = os.path.join(self.output_dir, my_paths.snapshot_dir)
+            snap_stem = os.path.splitext(snap_name)[0]
             for f in os.listdir(snap_dir):
-                if f == snap_name:
+                if f.startswith(snap_stem):
                     continue
                 f_path = os.path.join(snap_dir, f)
                 if f.startswith("202") and os.path.isfile(f_path):
@@ -1061,6 +1891,7 @@ class EcalMonitoring:
         self.logger.debug(
             f"🔎A new monitoring snapshot is ready: {snap_name} at {snap_path}"
         )
+        self._record_lags("snapshot", build_parts)
         return snap_path
 
     def _wrap_up(self, queues):
@@ -1071,15 +1902,16 @@ class EcalMonitoring:
                 "No access to the final buildfile was granted."
             )
         else:
+            if self._build_store is not None:
+                build_file = current_build_queue.get()
+                self._consolidate_segments(build_file)
+                current_build_queue.put(build_file)
+                current_build_queue.task_done()
             if hasattr(self, "_stopped_gracefully") and self._stopped_gracefully:
                 snapshot_name = "stopped_run.root"
             else:
                 snapshot_name = "full_run.root"
-                quality_info.get_quality_info(
-                    current_build_queue=current_build_queue,
-                    monitoring=self,
-                    finished=True,
-                )
+                self._update_quality_info(finished=True)
             build_file = current_build_queue.get()
             self.get_snapshot(
                 current_build_queue=None,
@@ -1098,7 +1930,12 @@ class EcalMonitoring:
             file_name = f"times_{os.path.basename(os.path.abspath(__file__))}.csv"
             file_name = os.path.join(times_dir, file_name)
         lines = [",".join(self.times[-1][0]._fields)]
-        for t in [v for per_worker in self.times.values() for v in per_worker]:
+        all_times = [v for per_worker in self.times.values() for v in per_worker]
+        if getattr(self, "_root_pool", None) is not None:
+            all_times.extend(self._root_pool.times)
+        if getattr(self, "_part_decorations", None) is not None:
+            all_times.extend(self._part_decorations.times)
+        for t in all_times:
             lines.append(
                 f"{t.job_type},{t.time:.3f},{t.timestamp}"
                 f",{t.id},{t.worker},{t.data_path}"
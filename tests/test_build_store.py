@@ -0,0 +1,96 @@
+import importlib.util
+import os
+
+import pytest
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_from(*path_parts):
+    file_path = os.path.join(repo_root, *path_parts)
+    module_name = os.path.splitext(os.path.basename(file_path))[0]
+    spec = importlib.util.spec_from_file_location(module_name, file_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+build_store = import_from("continuous_event_building", "build_store.py")
+
+
+def write_parts(output_dir, n_parts):
+    build_dir = os.path.join(output_dir, "build")
+    os.makedirs(build_dir, exist_ok=True)
+    paths = []
+    for i in range(n_parts):
+        paths.append(os.path.join(build_dir, f"build_run.dat_{i:04}.root"))
+        with open(paths[-1], "w") as f:
+            f.write(f"{i}\n")
+    return paths
+
+
+def concatenate(out_path, in_paths):
+    with open(out_path, "w") as out:
+        for path in in_paths:
+            with open(path) as f:
+                out.write(f.read())
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    for name in ["compacted", "tmp"]:
+        os.mkdir(tmp_path / name)
+    return str(tmp_path)
+
+
+def test_manifest_is_reloaded(store_dir):
+    parts = write_parts(store_dir, 3)
+    store = build_store.BuildStore(store_dir)
+    for part in parts:
+        store.append(part)
+    reloaded = build_store.BuildStore(store_dir)
+    assert reloaded.segment_paths() == parts
+    assert reloaded.n_parts() == 3
+
+
+def test_reconcile_adds_unrecorded_parts_once(store_dir):
+    parts = write_parts(store_dir, 4)
+    store = build_store.BuildStore(store_dir)
+    store.append(parts[0])
+    assert store.reconcile(parts) == 3
+    assert store.reconcile(parts) == 0
+    assert build_store.BuildStore(store_dir).segment_paths() == parts
+
+
+def test_compaction_keeps_order_and_content(store_dir):
+    parts = write_parts(store_dir, 5)
+    store = build_store.BuildStore(store_dir)
+    for part in parts:
+        store.append(part)
+    compactor = build_store.SegmentCompactor(
+        store,
+        concatenate,
+        os.path.join(store_dir, "compacted"),
+        os.path.join(store_dir, "tmp"),
+        parts_per_segment=2,
+    )
+    while compactor._compact_next():
+        pass
+    compactor.close()
+    segments = store.segment_paths()
+    assert [os.path.basename(s) for s in segments] == [
+        "compacted_0000.root",
+        "compacted_0001.root",
+        os.path.basename(parts[4]),
+    ]
+    assert store.uncompacted() == [parts[4]]
+    assert store.n_parts() == 5
+    content = ""
+    for segment in segments:
+        with open(segment) as f:
+            content += f.read()
+    assert content == "".join(f"{i}\n" for i in range(5))
+    # Compacted parts are known: They are not added again after a restart.
+    reloaded = build_store.BuildStore(store_dir)
+    assert reloaded.reconcile(parts) == 0
+    assert reloaded.segment_paths() == segments
@@ -0,0 +1,92 @@
+import importlib.util
+import os
+
+import pytest
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_from(*path_parts):
+    file_path = os.path.join(repo_root, *path_parts)
+    module_name = os.path.splitext(os.path.basename(file_path))[0]
+    spec = importlib.util.spec_from_file_location(module_name, file_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+job_journal = import_from("continuous_event_building", "job_journal.py")
+
+
+def test_part_name_matches_across_stages():
+    names = {
+        job_journal.part_name("/raw/run_1.dat_0003"),
+        job_journal.part_name("/out/converted/converted_run_1.dat_0003.root"),
+        job_journal.part_name("/out/build/build_run_1.dat_0003.root"),
+    }
+    assert names == {"run_1.dat_0003"}
+    # The converter names the first part (without number) _0000.
+    assert job_journal.part_name("/raw/run_1.dat") == "run_1.dat_0000"
+
+
+def test_replay_after_restart(tmp_path):
+    journal = job_journal.JobJournal(str(tmp_path))
+    assert journal.is_empty()
+    journal.record("discovered", "/raw/run_1.dat_0001", id_part=1)
+    journal.record("converted", "/out/converted/converted_run_1.dat_0001.root")
+    journal.record("discovered", "/raw/run_1.dat_0002", id_part=2)
+    journal.close()
+
+    journal = job_journal.JobJournal(str(tmp_path))
+    assert not journal.is_empty()
+    assert journal.stage("/raw/run_1.dat_0001") == "converted"
+    assert journal.stage("/raw/run_1.dat_0002") == "discovered"
+    assert journal.stage("/raw/run_1.dat_0003") is None
+    converted = journal.entries("converted")
+    # The id of the earlier stage is kept.
+    assert converted["run_1.dat_0001"].id == 1
+    assert journal.paths("converted") == [
+        "/out/converted/converted_run_1.dat_0001.root"
+    ]
+    journal.close()
+
+
+def test_stage_counters(tmp_path):
+    journal = job_journal.JobJournal(str(tmp_path))
+    for i in range(3):
+        journal.record("discovered", f"/raw/run_1.dat_{i:04}", id_part=i)
+    journal.record("converted", "/out/converted/converted_run_1.dat_0000.root")
+    journal.record("merged", "/out/build/build_run_1.dat_0000.root")
+    journal.record("converted", "/out/converted/converted_run_1.dat_0001.root")
+    counts = {s: journal.n_parts(s) for s in ["discovered", "converted", "merged"]}
+    assert counts == {"discovered": 1, "converted": 1, "merged": 1}
+    journal.close()
+    # The counters are rebuilt by the replay.
+    journal = job_journal.JobJournal(str(tmp_path))
+    assert {s: journal.n_parts(s) for s in counts} == counts
+    journal.close()
+
+
+def test_milestones_and_lags(tmp_path):
+    journal = job_journal.JobJournal(str(tmp_path))
+    journal.record("discovered", "/raw/run_1.dat_0001", id_part=1)
+    journal.record("discovered", "/raw/run_1.dat_0002", id_part=2)
+    discovered = journal.first_time("/raw/run_1.dat_0001", "discovered")
+    build_part = "/out/build/build_run_1.dat_0001.root"
+    lags = journal.mark("snapshot", [build_part], timestamp=discovered + 10)
+    assert lags == [pytest.approx(10)]
+    # Only the first time counts.
+    assert journal.mark("snapshot", [build_part], timestamp=discovered + 20) == []
+    # Parts that were never discovered (e.g. from an older run) have no lag.
+    assert journal.mark("snapshot", ["/out/build/build_run_2.dat_0001.root"]) == []
+    journal.close()
+    journal = job_journal.JobJournal(str(tmp_path))
+    assert journal.lags("snapshot") == [pytest.approx(10)]
+    assert journal.first_time(build_part, "snapshot") == discovered + 10
+    journal.close()
+
+
+def test_lag_summary():
+    summary = job_journal.lag_summary([float(lag) for lag in range(100, 0, -1)])
+    assert summary == "p50 50s, p95 95s, max 100s over 100 parts"
+    assert job_journal.lag_summary([3]) == "p50 3s, p95 3s, max 3s over 1 parts"
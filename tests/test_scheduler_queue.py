@@ -0,0 +1,135 @@
+import importlib.util
+import os
+import queue
+import threading
+import time
+
+import pytest
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_from(*path_parts):
+    file_path = os.path.join(repo_root, *path_parts)
+    module_name = os.path.splitext(os.path.basename(file_path))[0]
+    spec = importlib.util.spec_from_file_location(module_name, file_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+start_monitoring_run = import_from("start_monitoring_run.py")
+Priority = start_monitoring_run.Priority
+SchedulerQueue = start_monitoring_run.SchedulerQueue
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces the monotonic clock of the queue (for the aging)."""
+    now = [0.0]
+    monkeypatch.setattr(start_monitoring_run.time, "monotonic", lambda: now[0])
+    return now
+
+
+def take_all(job_queue):
+    items = []
+    while True:
+        try:
+            items.append(job_queue.get(block=False))
+        except queue.Empty:
+            return items
+
+
+def test_priority_order():
+    job_queue = SchedulerQueue()
+    job_queue.put((Priority.CONVERSION, -1, "raw_1"))
+    job_queue.put((Priority.EVENT_BUILDING, -2, "converted_2"))
+    job_queue.put((Priority.SNAP_SHOT, 0, "not used"))
+    stages = [item[0] for item in take_all(job_queue)]
+    assert stages == [Priority.SNAP_SHOT, Priority.EVENT_BUILDING, Priority.CONVERSION]
+
+
+def test_dedup_coalesces_placeholders():
+    job_queue = SchedulerQueue()
+    assert job_queue.put((Priority.MERGE_EVENT_BUILDING, 0, "not used"))
+    assert not job_queue.put((Priority.MERGE_EVENT_BUILDING, 0, "not used"))
+    assert job_queue.put((Priority.CONVERSION, -1, "raw_1"))
+    assert not job_queue.put((Priority.CONVERSION, -1, "raw_1"))
+    assert job_queue.qsize() == 2
+    assert job_queue.depth_by_stage() == {"MERGE_EVENT_BUILDING": 1, "CONVERSION": 1}
+    take_all(job_queue)
+    # Once handed out, the same job can be queued again.
+    assert job_queue.put((Priority.MERGE_EVENT_BUILDING, 0, "not used"))
+
+
+def test_stage_limits():
+    job_queue = SchedulerQueue(stage_limits={Priority.EVENT_BUILDING: 1})
+    job_queue.put((Priority.EVENT_BUILDING, -1, "converted_1"))
+    job_queue.put((Priority.EVENT_BUILDING, -2, "converted_2"))
+    job_queue.put((Priority.CONVERSION, -3, "raw_3"))
+    assert job_queue.n_available() == 2
+    assert job_queue.get(block=False)[2] == "converted_2"
+    # The capped stage waits, other stages can still be taken.
+    assert job_queue.n_available() == 1
+    assert job_queue.get(block=False)[2] == "raw_3"
+    with pytest.raises(queue.Empty):
+        job_queue.get(block=False)
+    job_queue.finished(Priority.CONVERSION)
+    assert job_queue.n_available() == 0
+    job_queue.finished(Priority.EVENT_BUILDING)
+    assert job_queue.n_available() == 1
+    assert job_queue.get(block=False)[2] == "converted_1"
+
+
+def test_finished_wakes_a_capped_consumer():
+    job_queue = SchedulerQueue(stage_limits={Priority.EVENT_BUILDING: 1})
+    job_queue.put((Priority.EVENT_BUILDING, -1, "converted_1"))
+    job_queue.put((Priority.EVENT_BUILDING, -2, "converted_2"))
+    job_queue.get(block=False)
+    taken = []
+    consumer = threading.Thread(target=lambda: taken.append(job_queue.get(timeout=5)))
+    consumer.start()
+    time.sleep(0.05)
+    assert taken == []
+    job_queue.finished(Priority.EVENT_BUILDING)
+    consumer.join(timeout=5)
+    assert [item[2] for item in taken] == ["converted_1"]
+
+
+def test_aging(clock):
+    job_queue = SchedulerQueue(aging=10)
+    job_queue.put((Priority.CONVERSION, -1, "raw_1"))
+    clock[0] = 25  # Two priority levels up: Ahead of the event building.
+    job_queue.put((Priority.EVENT_BUILDING, -2, "converted_2"))
+    assert [item[2] for item in take_all(job_queue)] == ["raw_1", "converted_2"]
+
+    job_queue.put((Priority.CONVERSION, -3, "raw_3"))
+    clock[0] = 30  # Not waited long enough.
+    job_queue.put((Priority.EVENT_BUILDING, -4, "converted_4"))
+    assert [item[2] for item in take_all(job_queue)] == ["converted_4", "raw_3"]
+
+
+def test_wake_up_ends_the_wait():
+    job_queue = SchedulerQueue()
+    generation = job_queue.generation
+    job_queue.wake_up()
+    # The generation changed since it was taken: No waiting at all.
+    start_time = time.time()
+    with pytest.raises(queue.Empty):
+        job_queue.get(timeout=5, generation=generation)
+    assert time.time() - start_time < 1
+
+    raised = []
+
+    def wait():
+        try:
+            job_queue.get(timeout=5, generation=job_queue.generation)
+        except queue.Empty:
+            raised.append(time.time())
+
+    consumer = threading.Thread(target=wait)
+    consumer.start()
+    time.sleep(0.05)
+    job_queue.wake_up()
+    consumer.join(timeout=5)
+    assert len(raised) == 1 and raised[0] - start_time < 1